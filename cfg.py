@@ -0,0 +1,132 @@
+"""
+Basic blocks and control flow graphs over the peephole code generator's
+instruction lists.
+
+A block starts at a label, or just after a branch or jump, and ends with the
+first branch or jump.  Blocks hold on to the very instruction objects they
+were built from, so a pass may rewrite instructions in place and then
+flatten() the graph back into a list.
+"""
+
+# peephole imports this module in turn, so its op codes are only looked up
+# once both have loaded.
+import peephole
+
+
+def is_label(i):
+    return i.op == peephole.OP_LABEL
+
+
+def is_branch(i):
+    return i.op == peephole.OP_BEQ or i.op == peephole.OP_BNE
+
+
+def ends_block(i):
+    return is_branch(i) or i.op == peephole.OP_JAL or i.op == peephole.OP_JALR
+
+
+class BasicBlock(object):
+    def __init__(self, index):
+        self.index = index
+        self.labels = []
+        self.insns = []
+        self.succs = []
+        self.preds = []
+
+    def terminator(self):
+        if len(self.insns) > 0 and ends_block(self.insns[-1]):
+            return self.insns[-1]
+        return None
+
+    def falls_through(self):
+        """
+        True if control can continue into the next block in program order.
+        Calls return to the following instruction; jumps and returns don't.
+        """
+        t = self.terminator()
+        if t is None:
+            return True
+        if t.op == peephole.OP_JAL or t.op == peephole.OP_JALR:
+            return t.dest != 0
+        return True
+
+    def single_predecessor(self):
+        """
+        The one block control can arrive from, or None.  Blocks with labels
+        other code can name from outside (subroutine entry points) never
+        have a single predecessor.
+        """
+        for l in self.labels:
+            if not getattr(l, "local", True):
+                return None
+        if len(self.preds) == 1:
+            return self.preds[0]
+        return None
+
+    def __repr__(self):
+        return "<BB{} {} succs={} preds={}>".format(
+            self.index,
+            [l.name for l in self.labels],
+            [b.index for b in self.succs],
+            [b.index for b in self.preds],
+        )
+
+
+class CFG(object):
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.by_label = {}
+        for b in blocks:
+            for l in b.labels:
+                self.by_label[l.name] = b
+        self.link()
+
+    def link(self):
+        for b in self.blocks:
+            b.succs = []
+            b.preds = []
+
+        for n, b in enumerate(self.blocks):
+            t = b.terminator()
+            if t is not None and t.op != peephole.OP_JALR and (is_branch(t) or t.dest == 0):
+                target = self.by_label.get(t.label.name)
+                if target is not None:
+                    self.edge(b, target)
+            if b.falls_through() and n+1 < len(self.blocks):
+                self.edge(b, self.blocks[n+1])
+
+    def edge(self, frm, to):
+        if to not in frm.succs:
+            frm.succs.append(to)
+            to.preds.append(frm)
+
+    def block_for(self, label):
+        return self.by_label.get(label.name)
+
+    def flatten(self):
+        I = []
+        for b in self.blocks:
+            I.extend(b.labels)
+            I.extend(b.insns)
+        return I
+
+
+def build(insns):
+    """Splits a list of instructions into basic blocks, and links them."""
+    blocks = []
+    b = None
+    for i in insns:
+        if is_label(i):
+            if b is None or len(b.insns) > 0:
+                b = BasicBlock(len(blocks))
+                blocks.append(b)
+            b.labels.append(i)
+            continue
+
+        if b is None:
+            b = BasicBlock(len(blocks))
+            blocks.append(b)
+        b.insns.append(i)
+        if ends_block(i):
+            b = None
+    return CFG(blocks)
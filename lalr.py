@@ -0,0 +1,258 @@
+"""
+An LALR(1) parser generator.
+
+A grammar is a list of (nonterminal, right-hand side, action) rules, the
+right-hand side being a string of space-separated symbols.  Any symbol that
+never appears on a left-hand side is a terminal.  The first rule's
+nonterminal is the start symbol, and "$end" is the terminal that ends the
+input.
+
+Tables are built from the canonical LR(1) item sets, merging the sets that
+share a core, and can be cached on disk keyed by a hash of the grammar, so
+they're only rebuilt when the grammar changes.
+"""
+
+import hashlib
+import json
+import os
+
+
+END = "$end"
+ACCEPT = "$accept"
+
+# Bump when the table format or construction changes, to invalidate caches.
+VERSION = 1
+
+
+class Grammar(object):
+    def __init__(self, rules):
+        self.productions = [(ACCEPT, (rules[0][0], END), None)]
+        for lhs, rhs, action in rules:
+            self.productions.append((lhs, tuple(rhs.split()), action))
+
+        self.nonterminals = set([p[0] for p in self.productions])
+        self.terminals = set([END])
+        for lhs, rhs, action in self.productions:
+            for x in rhs:
+                if x not in self.nonterminals:
+                    self.terminals.add(x)
+
+        self.by_lhs = {}
+        for n, p in enumerate(self.productions):
+            self.by_lhs.setdefault(p[0], []).append(n)
+
+        self.compute_first()
+
+    def signature(self):
+        text = json.dumps([VERSION, self.productions], sort_keys=True)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def compute_first(self):
+        self.nullable = set()
+        self.first = dict([(n, set()) for n in self.nonterminals])
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, action in self.productions:
+                before = (lhs in self.nullable, len(self.first[lhs]))
+                f = self.first_of(rhs)
+                self.first[lhs] |= f - set([None])
+                if None in f:
+                    self.nullable.add(lhs)
+                if (lhs in self.nullable, len(self.first[lhs])) != before:
+                    changed = True
+
+    def first_of(self, symbols):
+        """
+        Terminals that can start the symbol string, plus None if it can
+        derive the empty string.
+        """
+        result = set()
+        for x in symbols:
+            if x in self.terminals:
+                result.add(x)
+                return result
+            result |= self.first[x]
+            if x not in self.nullable:
+                return result
+        result.add(None)
+        return result
+
+
+class Tables(object):
+    """
+    action[state][terminal] is ("s", state), ("r", production) or ("a",).
+    goto[state][nonterminal] is a state.  default[state] is the production
+    to reduce by without looking at the next token, or None.  symbol[state]
+    is the symbol every transition into the state is on (None for the start
+    state), so a stack of states is enough to know the symbols too.
+    """
+
+    def __init__(self, productions, action, goto, default):
+        self.productions = productions
+        self.action = action
+        self.goto = goto
+        self.default = default
+
+        self.symbol = [None] * len(action)
+        for row in action:
+            for t, a in row.items():
+                if a[0] == "s":
+                    self.symbol[a[1]] = t
+        for row in goto:
+            for x, state in row.items():
+                self.symbol[state] = x
+
+    def to_json(self):
+        return {
+            "productions": [[lhs, list(rhs), action] for lhs, rhs, action in self.productions],
+            "action": self.action,
+            "goto": self.goto,
+            "default": self.default,
+        }
+
+    @classmethod
+    def from_json(cls, d):
+        # str() turns the unicode Python 2's json hands back into plain
+        # strings, so symbols look the same however the tables were made.
+        productions = []
+        for lhs, rhs, action in d["productions"]:
+            if action is not None:
+                action = str(action)
+            productions.append((str(lhs), tuple([str(x) for x in rhs]), action))
+        action = [dict([(str(t), tuple(a)) for t, a in row.items()]) for row in d["action"]]
+        goto = [dict([(str(x), s) for x, s in row.items()]) for row in d["goto"]]
+        return cls(productions, action, goto, d["default"])
+
+
+def closure(g, items):
+    items = set(items)
+    work = list(items)
+    while len(work) > 0:
+        p, dot, la = work.pop()
+        rhs = g.productions[p][1]
+        if dot >= len(rhs) or rhs[dot] not in g.nonterminals:
+            continue
+        lookaheads = g.first_of(rhs[dot+1:])
+        if None in lookaheads:
+            lookaheads.discard(None)
+            lookaheads.add(la)
+        for q in g.by_lhs[rhs[dot]]:
+            for b in lookaheads:
+                item = (q, 0, b)
+                if item not in items:
+                    items.add(item)
+                    work.append(item)
+    return frozenset(items)
+
+
+def advance(g, items, x):
+    moved = [(p, dot+1, la) for p, dot, la in items
+             if dot < len(g.productions[p][1]) and g.productions[p][1][dot] == x]
+    if len(moved) == 0:
+        return None
+    return closure(g, moved)
+
+
+def core(items):
+    return frozenset([(p, dot) for p, dot, la in items])
+
+
+def build(g):
+    """Builds LALR(1) tables for the grammar, or raises on a conflict."""
+    symbols = sorted(g.terminals | g.nonterminals)
+
+    # Canonical LR(1) collection.
+    start = closure(g, [(0, 0, END)])
+    states = [start]
+    index = {start: 0}
+    edges = []
+    n = 0
+    while n < len(states):
+        e = {}
+        for x in symbols:
+            if x == END:
+                continue
+            t = advance(g, states[n], x)
+            if t is None:
+                continue
+            if t not in index:
+                index[t] = len(states)
+                states.append(t)
+            e[x] = index[t]
+        edges.append(e)
+        n = n + 1
+
+    # Merge states with the same core, numbering merged states in order of
+    # their first appearance.
+    merged = {}
+    number = []
+    for s in states:
+        c = core(s)
+        if c not in merged:
+            merged[c] = len(merged)
+        number.append(merged[c])
+    items = [set() for _ in merged]
+    for n, s in enumerate(states):
+        items[number[n]] |= s
+
+    action = [{} for _ in merged]
+    goto = [{} for _ in merged]
+
+    def add(state, t, a):
+        old = action[state].get(t)
+        if old is not None and old != a:
+            raise Exception("Conflict in state {} on {}: {} or {}".format(state, t, old, a))
+        action[state][t] = a
+
+    for n, s in enumerate(states):
+        m = number[n]
+        for x, target in edges[n].items():
+            if x in g.terminals:
+                add(m, x, ("s", number[target]))
+            else:
+                goto[m][x] = number[target]
+
+    for m, s in enumerate(items):
+        for p, dot, la in s:
+            if dot == len(g.productions[p][1]):
+                add(m, la, ("r", p))
+            elif p == 0 and g.productions[p][1][dot] == END:
+                add(m, END, ("a",))
+
+    default = []
+    for row in action:
+        acts = set(row.values())
+        if len(acts) == 1 and list(acts)[0][0] == "r":
+            default.append(list(acts)[0][1])
+        else:
+            default.append(None)
+
+    return Tables(g.productions, action, goto, default)
+
+
+def load(rules, path):
+    """
+    Returns tables for the grammar, from the cache file at path if it was
+    written for this very grammar, and otherwise freshly built (and cached
+    there, if path is writable).
+    """
+    g = Grammar(rules)
+    signature = g.signature()
+    try:
+        with open(path) as f:
+            d = json.load(f)
+        if d.get("signature") == signature:
+            return Tables.from_json(d["tables"])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    tables = build(g)
+    try:
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"signature": signature, "tables": tables.to_json()}, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+    return tables
@@ -0,0 +1,2330 @@
+from __future__ import print_function
+
+import json
+import struct
+import sys
+
+import cfg
+
+
+class Insn(object):
+    __slots__ = ()
+
+    def is_small_const(self):
+        return self.op == OP_ORI and self.dest != 0 and self.src1 == 0
+
+
+# Small integer opcodes.  Every instruction class carries one as its op, so
+# the optimizer's rules compare integers rather than mnemonic strings.
+(
+    OP_LABEL,
+    OP_SRAI,
+    OP_SLLI,
+    OP_SRLI,
+    OP_BEQ,
+    OP_BNE,
+    OP_ADD,
+    OP_XOR,
+    OP_AND,
+    OP_SUB,
+    OP_OR,
+    OP_MUL,
+    OP_SLL,
+    OP_SRL,
+    OP_SRA,
+    OP_ORI,
+    OP_ADDI,
+    OP_ANDI,
+    OP_XORI,
+    OP_AUIPC,
+    OP_LUI,
+    OP_LB,
+    OP_SB,
+    OP_LD,
+    OP_SD,
+    OP_JALR,
+    OP_JAL,
+    OP_SLTU,
+    OP_SLTIU,
+) = range(29)
+
+
+def check_signed(n, bits):
+    if not (-(1 << (bits-1)) <= n < (1 << (bits-1))):
+        raise Exception("{} doesn't fit in a {}-bit field".format(n, bits))
+
+
+def check_shamt(n):
+    if not (0 <= n < 64):
+        raise Exception("Shift amount {} out of range".format(n))
+
+
+def r_type(opcode, funct3, funct7, rd, rs1, rs2):
+    return (funct7 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+
+def i_type(opcode, funct3, rd, rs1, imm):
+    check_signed(imm, 12)
+    return ((imm & 0xFFF) << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+
+def s_type(opcode, funct3, rs1, rs2, imm):
+    check_signed(imm, 12)
+    imm = imm & 0xFFF
+    return ((imm >> 5) << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | ((imm & 0x1F) << 7) | opcode
+
+
+def b_type(funct3, rs1, rs2, offset):
+    check_signed(offset, 13)
+    imm = offset & 0x1FFF
+    return ((((imm >> 12) & 1) << 31) | (((imm >> 5) & 0x3F) << 25) | (rs2 << 20) | (rs1 << 15) |
+            (funct3 << 12) | (((imm >> 1) & 0xF) << 8) | (((imm >> 11) & 1) << 7) | 0x63)
+
+
+def u_type(opcode, rd, imm20):
+    check_signed(imm20, 20)
+    return ((imm20 & 0xFFFFF) << 12) | (rd << 7) | opcode
+
+
+def j_type(rd, offset):
+    check_signed(offset, 21)
+    imm = offset & 0x1FFFFF
+    return ((((imm >> 20) & 1) << 31) | (((imm >> 1) & 0x3FF) << 21) | (((imm >> 11) & 1) << 20) |
+            (((imm >> 12) & 0xFF) << 12) | (rd << 7) | 0x6F)
+
+
+def displacement(label, pc, labels):
+    if label.name not in labels:
+        raise Exception("Undefined label {}".format(label.name))
+    return labels[label.name] - pc
+
+
+class SRAI(Insn):
+    __slots__ = ("dest", "src1", "imm12")
+    opc = "srai"
+    op = OP_SRAI
+
+    def __init__(self, rd, rs, imm12):
+        self.dest = rd
+        self.src1 = rs
+        self.imm12 = imm12
+
+    def encode(self, pc, labels):
+        check_shamt(self.imm12)
+        return i_type(0x13, 5, self.dest, self.src1, 0x400 | self.imm12)
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, {}".format(self.opc, self.dest, self.src1, self.imm12)
+
+
+class SLLI(Insn):
+    __slots__ = ("dest", "src1", "imm12")
+    opc = "slli"
+    op = OP_SLLI
+
+    def __init__(self, rd, rs, imm12):
+        self.dest = rd
+        self.src1 = rs
+        self.imm12 = imm12
+
+    def encode(self, pc, labels):
+        check_shamt(self.imm12)
+        return i_type(0x13, 1, self.dest, self.src1, self.imm12)
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, {}".format(self.opc, self.dest, self.src1, self.imm12)
+
+
+class SRLI(Insn):
+    __slots__ = ("dest", "src1", "imm12")
+    opc = "srli"
+    op = OP_SRLI
+
+    def __init__(self, rd, rs, imm12):
+        self.dest = rd
+        self.src1 = rs
+        self.imm12 = imm12
+
+    def encode(self, pc, labels):
+        check_shamt(self.imm12)
+        return i_type(0x13, 5, self.dest, self.src1, self.imm12)
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, {}".format(self.opc, self.dest, self.src1, self.imm12)
+
+
+class BEQ(Insn):
+    __slots__ = ("src1", "src2", "label")
+    opc = "beq"
+    op = OP_BEQ
+
+    def __init__(self, r1, r2, label):
+        self.src1 = r1
+        self.src2 = r2
+        self.label = label
+
+    def encode(self, pc, labels):
+        return b_type(0, self.src1, self.src2, displacement(self.label, pc, labels))
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, {}".format(self.opc, self.src1, self.src2, self.label.name)
+
+
+class BNE(Insn):
+    __slots__ = ("src1", "src2", "label")
+    opc = "bne"
+    op = OP_BNE
+
+    def __init__(self, r1, r2, label):
+        self.src1 = r1
+        self.src2 = r2
+        self.label = label
+
+    def encode(self, pc, labels):
+        return b_type(1, self.src1, self.src2, displacement(self.label, pc, labels))
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, {}".format(self.opc, self.src1, self.src2, self.label.name)
+
+
+class Label(Insn):
+    __slots__ = ("name", "local")
+    opc = ":label:"
+    op = OP_LABEL
+
+    def __init__(self, name, local=False):
+        self.name = name
+        # Labels we generate ourselves can't be referenced from outside
+        # the program being compiled.
+        self.local = local
+
+    def __repr__(self):
+        return "\n{}:".format(self.name)
+
+
+class ADD(Insn):
+    __slots__ = ("dest", "src1", "src2")
+    opc = "add"
+    op = OP_ADD
+
+    def __init__(self, dest, src1, src2):
+        self.dest = dest
+        self.src1 = src1
+        self.src2 = src2
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 0, 0, self.dest, self.src1, self.src2)
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, X{}".format(self.opc, self.dest, self.src1, self.src2)
+
+
+class XOR(Insn):
+    __slots__ = ("dest", "src1", "src2")
+    opc = "xor"
+    op = OP_XOR
+
+    def __init__(self, dest, src1, src2):
+        self.dest = dest
+        self.src1 = src1
+        self.src2 = src2
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 4, 0, self.dest, self.src1, self.src2)
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, X{}".format(self.opc, self.dest, self.src1, self.src2)
+
+
+class AND(Insn):
+    __slots__ = ("dest", "src1", "src2")
+    opc = "and"
+    op = OP_AND
+
+    def __init__(self, dest, src1, src2):
+        self.dest = dest
+        self.src1 = src1
+        self.src2 = src2
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 7, 0, self.dest, self.src1, self.src2)
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, X{}".format(self.opc, self.dest, self.src1, self.src2)
+
+
+class RegInsn(Insn):
+    __slots__ = ("dest", "src1", "src2")
+
+    def reset(self, dest, src1, src2):
+        self.dest = dest
+        self.src1 = src1
+        self.src2 = src2
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, X{}".format(self.opc, self.dest, self.src1, self.src2)
+
+
+class SUB(RegInsn):
+    __slots__ = ()
+    opc = "sub"
+    op = OP_SUB
+
+    def __init__(self, dest, src1, src2):
+        self.reset(dest, src1, src2)
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 0, 0x20, self.dest, self.src1, self.src2)
+
+
+class OR(RegInsn):
+    __slots__ = ()
+    opc = "or"
+    op = OP_OR
+
+    def __init__(self, dest, src1, src2):
+        self.reset(dest, src1, src2)
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 6, 0, self.dest, self.src1, self.src2)
+
+
+class MUL(RegInsn):
+    __slots__ = ()
+    opc = "mul"
+    op = OP_MUL
+
+    def __init__(self, dest, src1, src2):
+        self.reset(dest, src1, src2)
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 0, 1, self.dest, self.src1, self.src2)
+
+
+class SLL(RegInsn):
+    __slots__ = ()
+    opc = "sll"
+    op = OP_SLL
+
+    def __init__(self, dest, src1, src2):
+        self.reset(dest, src1, src2)
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 1, 0, self.dest, self.src1, self.src2)
+
+
+class SRL(RegInsn):
+    __slots__ = ()
+    opc = "srl"
+    op = OP_SRL
+
+    def __init__(self, dest, src1, src2):
+        self.reset(dest, src1, src2)
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 5, 0, self.dest, self.src1, self.src2)
+
+
+class SRA(RegInsn):
+    __slots__ = ()
+    opc = "sra"
+    op = OP_SRA
+
+    def __init__(self, dest, src1, src2):
+        self.reset(dest, src1, src2)
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 5, 0x20, self.dest, self.src1, self.src2)
+
+
+class SLTU(RegInsn):
+    __slots__ = ()
+    opc = "sltu"
+    op = OP_SLTU
+
+    def __init__(self, dest, src1, src2):
+        self.reset(dest, src1, src2)
+
+    def encode(self, pc, labels):
+        return r_type(0x33, 3, 0, self.dest, self.src1, self.src2)
+
+
+class ImmInsn(Insn):
+    __slots__ = ("dest", "src1", "imm12")
+
+    def reset(self, dest, src, imm):
+        self.dest = dest
+        self.src1 = src
+        self.imm12 = imm
+
+    def __repr__(self):
+        return "\t{}\tX{}, X{}, {}".format(self.opc, self.dest, self.src1, self.imm12)
+
+class ORI(ImmInsn):
+    __slots__ = ()
+    opc = "ori"
+    op = OP_ORI
+
+    def __init__(self, dest, src, imm):
+        self.reset(dest, src, imm)
+
+    def encode(self, pc, labels):
+        return i_type(0x13, 6, self.dest, self.src1, self.imm12)
+
+
+class ADDI(ImmInsn):
+    __slots__ = ("anchor",)
+    opc = "addi"
+    op = OP_ADDI
+
+    def __init__(self, dest, src, imm):
+        self.reset(dest, src, imm)
+
+    def encode(self, pc, labels):
+        return i_type(0x13, 0, self.dest, self.src1, self.imm12)
+
+
+class ANDI(ImmInsn):
+    __slots__ = ()
+    opc = "andi"
+    op = OP_ANDI
+
+    def __init__(self, dest, src, imm):
+        self.reset(dest, src, imm)
+
+    def encode(self, pc, labels):
+        return i_type(0x13, 7, self.dest, self.src1, self.imm12)
+
+
+class XORI(ImmInsn):
+    __slots__ = ()
+    opc = "xori"
+    op = OP_XORI
+
+    def __init__(self, dest, src, imm):
+        self.reset(dest, src, imm)
+
+    def encode(self, pc, labels):
+        return i_type(0x13, 4, self.dest, self.src1, self.imm12)
+
+
+class SLTIU(ImmInsn):
+    __slots__ = ()
+    opc = "sltiu"
+    op = OP_SLTIU
+
+    def __init__(self, dest, src, imm):
+        self.reset(dest, src, imm)
+
+    def encode(self, pc, labels):
+        return i_type(0x13, 3, self.dest, self.src1, self.imm12)
+
+
+class AUIPC(Insn):
+    __slots__ = ("dest", "imm20", "pc", "pool_slot", "target")
+    opc = "auipc"
+    op = OP_AUIPC
+
+    def __init__(self, dest, imm20):
+        self.dest = dest
+        self.imm20 = imm20
+
+    def encode(self, pc, labels):
+        return u_type(0x17, self.dest, self.imm20)
+
+    def __repr__(self):
+        return "\t{}\tX{}, {}".format(self.opc, self.dest, self.imm20)
+
+
+class LUI(Insn):
+    __slots__ = ("dest", "imm20")
+    opc = "lui"
+    op = OP_LUI
+
+    def __init__(self, dest, imm20):
+        self.dest = dest
+        self.imm20 = imm20
+
+    def encode(self, pc, labels):
+        return u_type(0x37, self.dest, self.imm20)
+
+    def __repr__(self):
+        return "\t{}\tX{}, {}".format(self.opc, self.dest, self.imm20)
+
+
+class LB(Insn):
+    __slots__ = ("dest", "offset", "index")
+    opc = "lb"
+    op = OP_LB
+
+    def __init__(self, dest, offset, index):
+        self.dest = dest
+        self.offset = offset
+        self.index = index
+
+    def encode(self, pc, labels):
+        return i_type(0x03, 0, self.dest, self.index, self.offset)
+
+    def __repr__(self):
+        return "\t{}\tX{}, {}(X{})".format(self.opc, self.dest, self.offset, self.index)
+
+class SB(Insn):
+    __slots__ = ("src", "offset", "index")
+    opc = "sb"
+    op = OP_SB
+
+    def __init__(self, src, offset, index):
+        self.src = src
+        self.offset = offset
+        self.index = index
+
+    def encode(self, pc, labels):
+        return s_type(0x23, 0, self.index, self.src, self.offset)
+
+    def __repr__(self):
+        return "\t{}\tX{}, {}(X{})".format(self.opc, self.src, self.offset, self.index)
+
+class LD(Insn):
+    __slots__ = ("dest", "offset", "index", "pool_slot", "anchor")
+    opc = "ld"
+    op = OP_LD
+
+    def __init__(self, dest, offset, index):
+        self.dest = dest
+        self.offset = offset
+        self.index = index
+
+    def encode(self, pc, labels):
+        return i_type(0x03, 3, self.dest, self.index, self.offset)
+
+    def __repr__(self):
+        return "\t{}\tX{}, {}(X{})".format(self.opc, self.dest, self.offset, self.index)
+
+class SD(Insn):
+    __slots__ = ("src", "offset", "index", "pool_slot", "anchor")
+    opc = "sd"
+    op = OP_SD
+
+    def __init__(self, src, offset, index):
+        self.src = src
+        self.offset = offset
+        self.index = index
+
+    def encode(self, pc, labels):
+        return s_type(0x23, 3, self.index, self.src, self.offset)
+
+    def __repr__(self):
+        return "\t{}\tX{}, {}(X{})".format(self.opc, self.src, self.offset, self.index)
+
+class JALR(Insn):
+    __slots__ = ("dest", "offset", "index")
+    opc = "jalr"
+    op = OP_JALR
+
+    def __init__(self, dest, offset, index):
+        self.dest = dest
+        self.offset = offset
+        self.index = index
+
+    def encode(self, pc, labels):
+        return i_type(0x67, 0, self.dest, self.index, self.offset)
+
+    def __repr__(self):
+        return "\t{}\tX{}, {}(X{})".format(self.opc, self.dest, self.offset, self.index)
+
+
+class JAL(Insn):
+    __slots__ = ("dest", "label")
+    opc = "jal"
+    op = OP_JAL
+
+    def __init__(self, dest, label):
+        self.dest = dest
+        self.label = label
+
+    def encode(self, pc, labels):
+        return j_type(self.dest, displacement(self.label, pc, labels))
+
+    def __repr__(self):
+        return "\t{}\tX{}, {}".format(self.opc, self.dest, self.label.name)
+
+
+# Register-register ALU instructions, and the immediate forms the optimizer
+# may rewrite them into when one operand is a small constant.
+REG_OPS = {
+    OP_ADD: ADD, OP_SUB: SUB, OP_XOR: XOR, OP_AND: AND, OP_OR: OR, OP_MUL: MUL,
+    OP_SLL: SLL, OP_SRL: SRL, OP_SRA: SRA,
+}
+
+IMM_OPS = {
+    OP_ADD: ADDI, OP_XOR: XORI, OP_AND: ANDI, OP_OR: ORI,
+    OP_SLL: SLLI, OP_SRL: SRLI, OP_SRA: SRAI,
+}
+
+COMMUTATIVE = (OP_ADD, OP_XOR, OP_AND, OP_OR, OP_MUL)
+
+MASK64 = (1 << 64) - 1
+
+
+def signed64(n):
+    n = n & MASK64
+    if n & (1 << 63):
+        return n - (1 << 64)
+    return n
+
+
+FOLD = {
+    OP_ADD: lambda a, b: a + b,
+    OP_SUB: lambda a, b: a - b,
+    OP_XOR: lambda a, b: a ^ b,
+    OP_AND: lambda a, b: a & b,
+    OP_OR: lambda a, b: a | b,
+    OP_MUL: lambda a, b: a * b,
+    OP_SLL: lambda a, b: a << (b & 63),
+    OP_SRL: lambda a, b: (a & MASK64) >> (b & 63),
+    OP_SRA: lambda a, b: a >> (b & 63),
+}
+
+
+def is_power_of_two(n):
+    return n > 0 and (n & (n - 1)) == 0
+
+
+def log2(n):
+    return n.bit_length() - 1
+
+
+def mul_sequence(rd, t, k):
+    """
+    Returns the shift/add instructions computing rd = rd * k, using t as a
+    scratch register, or None if k has no short decomposition.  Handled are
+    powers of two, sums of two powers of two, and differences of two powers
+    of two, any of them negated.
+    """
+    n = abs(k)
+    if n == 0:
+        return [ORI(rd, 0, 0)]
+
+    if is_power_of_two(n):
+        seq = []
+        if n > 1:
+            seq.append(SLLI(rd, rd, log2(n)))
+    else:
+        low = n & -n
+        if is_power_of_two(n - low):
+            seq = [SLLI(t, rd, log2(n - low))]
+            if low > 1:
+                seq.append(SLLI(rd, rd, log2(low)))
+            seq.append(ADD(rd, rd, t))
+        elif is_power_of_two(n + low):
+            if low > 1:
+                seq = [SLLI(t, rd, log2(low))]
+            else:
+                seq = [ORI(t, rd, 0)]
+            seq.append(SLLI(rd, rd, log2(n + low)))
+            seq.append(SUB(rd, rd, t))
+        else:
+            return None
+
+    if k < 0:
+        seq.append(SUB(rd, 0, rd))
+    return seq
+
+
+def hi20_lo12(n):
+    """
+    Splits n into the upper 20 bits and the sign-extended lower 12 bits a
+    LUI/ADDI or AUIPC/LD pair needs to reconstruct it.
+    """
+    hi = (n + 0x800) >> 12
+    return hi, n - (hi << 12)
+
+
+def fits_imm12(n):
+    return -2048 <= n < 2048
+
+
+def fits_imm20(n):
+    return -0x80000 <= n < 0x80000
+
+
+def fits_branch(n):
+    """True if a BEQ or BNE can reach n bytes away."""
+    return -0x1000 <= n < 0x1000
+
+
+def addresses(insns):
+    """The address of each of insns, the code starting at 0."""
+    pcs = []
+    pc = 0
+    for i in insns:
+        pcs.append(pc)
+        if i.op != OP_LABEL:
+            pc = pc + 4
+    return pcs
+
+
+def code_size(insns):
+    return 4 * len([i for i in insns if i.op != OP_LABEL])
+
+
+def regs_read(i):
+    if i.op in (OP_LD, OP_LB, OP_JALR):
+        return [i.index]
+    if i.op in (OP_SD, OP_SB):
+        return [i.src, i.index]
+    return [getattr(i, a) for a in ["src1", "src2"] if hasattr(i, a)]
+
+
+def regs_written(i):
+    if hasattr(i, "dest") and i.dest != 0:
+        return [i.dest]
+    return []
+
+
+# Cycles from issuing an instruction until its result can be used, for a
+# simple in-order pipeline.  Anything not listed takes one cycle.
+LATENCY = {
+    OP_LD: 3,
+    OP_LB: 3,
+    OP_MUL: 4,
+}
+
+
+def schedule_block(insns, latency):
+    """
+    List-schedules the instructions of one basic block for an in-order
+    pipeline with the given latencies, keeping every register and memory
+    dependency.  A trailing branch or jump stays last, and AUIPC, whose
+    result depends on its own address, doesn't move relative to anything.
+    Returns the new order and the stall cycles before and after.
+    """
+    body = list(insns)
+    tail = []
+    if len(body) > 0 and body[-1].op in (OP_BEQ, OP_BNE, OP_JAL, OP_JALR):
+        tail = [body.pop()]
+    n = len(body)
+
+    def lat(i):
+        return latency.get(i.op, 1)
+
+    # Each instruction depends only on the nearest ones it has to follow:
+    # the last writer of each register it reads or writes, the readers
+    # since, the last store and the loads since it, and the last AUIPC.
+    # Anything earlier is ordered through those.
+    deps = [{} for k in range(n)]     # predecessor -> delay
+
+    def depend(j, k, delay):
+        if k != j and deps[j].get(k, -1) < delay:
+            deps[j][k] = delay
+
+    writer = {}
+    readers = {}
+    store = None
+    loads = []
+    auipc = None
+    for j in range(n):
+        b = body[j]
+        reads = [r for r in regs_read(b) if r != 0]
+        writes = regs_written(b)
+        for r in reads:
+            if r in writer:
+                depend(j, writer[r], lat(body[writer[r]]))
+        for r in writes:
+            if r in writer:
+                depend(j, writer[r], 0)
+            for k in readers.get(r, []):
+                depend(j, k, 0)
+        if b.op in (OP_LD, OP_LB, OP_SD, OP_SB) and store is not None:
+            depend(j, store, 1)
+        if b.op in (OP_SD, OP_SB):
+            for k in loads:
+                depend(j, k, 0)
+        if b.op == OP_AUIPC:
+            for k in range(0 if auipc is None else auipc, j):
+                depend(j, k, 0)
+        elif auipc is not None:
+            depend(j, auipc, 0)
+
+        for r in reads:
+            readers.setdefault(r, []).append(j)
+        for r in writes:
+            writer[r] = j
+            readers[r] = []
+        if b.op in (OP_SD, OP_SB):
+            store = j
+            loads = []
+        elif b.op in (OP_LD, OP_LB):
+            loads.append(j)
+        if b.op == OP_AUIPC:
+            auipc = j
+
+    preds = [sorted(deps[j].items()) for j in range(n)]     # (predecessor, delay)
+    succs = [[] for k in range(n)]
+    for j in range(n):
+        for k, delay in preds[j]:
+            succs[k].append((j, delay))
+
+    height = [0] * n
+    for k in reversed(range(n)):
+        height[k] = lat(body[k])
+        for j, delay in succs[k]:
+            height[k] = max(height[k], delay + height[j])
+
+    def stalls(order):
+        issued = {}
+        cycle = 0
+        total = 0
+        for k in order:
+            earliest = max([issued[p] + d for p, d in preds[k]] + [cycle])
+            total = total + earliest - cycle
+            issued[k] = earliest
+            cycle = earliest + 1
+        return total
+
+    # An instruction is ready once all its predecessors have issued, and
+    # can go no sooner than ready_at.
+    order = []
+    unissued = [len(preds[k]) for k in range(n)]
+    ready_at = [0] * n
+    ready = set([k for k in range(n) if unissued[k] == 0])
+    cycle = 0
+    while len(ready) > 0:
+        earliest, h, k = min([(max(ready_at[k], cycle), -height[k], k) for k in ready])
+        order.append(k)
+        cycle = earliest + 1
+        ready.remove(k)
+        for j, delay in succs[k]:
+            ready_at[j] = max(ready_at[j], earliest + delay)
+            unissued[j] = unissued[j] - 1
+            if unissued[j] == 0:
+                ready.add(j)
+
+    return [body[k] for k in order] + tail, stalls(range(n)), stalls(order)
+
+
+def label_addresses(insns, base):
+    """
+    Maps each label's name to its address, the code starting at base.
+    Raises if two labels share a name.
+    """
+    labels = {}
+    pc = base
+    for i in insns:
+        if i.op == OP_LABEL:
+            if i.name in labels:
+                raise Exception("Duplicate label {}".format(i.name))
+            labels[i.name] = pc
+        else:
+            pc = pc + 4
+    return labels
+
+
+def assemble(insns, pool):
+    """
+    Two-pass assembler.  The first pass gives every label its address, the
+    second encodes each instruction.  Returns the literal pool followed by
+    the code as one little-endian image.
+    """
+    base = 8 * len(pool)
+    labels = label_addresses(insns, base)
+
+    image = bytearray()
+    for c in pool:
+        image.extend(struct.pack("<Q", c & MASK64))
+    pc = base
+    for i in insns:
+        if i.op == OP_LABEL:
+            continue
+        image.extend(struct.pack("<I", i.encode(pc, labels)))
+        pc = pc + 4
+    return image
+
+
+class LiteralPool(object):
+    """
+    Holds the constants too large to synthesize inline.  The pool is laid out
+    immediately before the code, growing toward lower addresses, so a slot's
+    address never changes once it's been handed out.  Identical constants
+    share a slot.  Iterating yields the constants in memory order.
+    """
+    def __init__(self):
+        self.values = []
+        self.slots = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return reversed(self.values)
+
+    def __contains__(self, n):
+        return n in self.slots
+
+    def slot(self, n):
+        if n not in self.slots:
+            self.slots[n] = len(self.values)
+            self.values.append(n)
+        return self.slots[n]
+
+    def variable(self):
+        """A new slot, holding zero, that no constant will ever share."""
+        self.values.append(0)
+        return len(self.values) - 1
+
+    def address(self, slot):
+        """Byte address of slot, relative to the first instruction."""
+        return -8 * (slot + 1)
+
+
+# The peephole rules optimize() applies, by the names statistics() counts
+# them under.
+RULES = [
+    "fold-constants",
+    "immediate-form",
+    "copy-into-ld-base",
+    "copy-into-sd-base",
+    "copy-into-sd-value",
+    "copy-into-lb-base",
+    "copy-into-sb-base",
+    "copy-into-sb-value",
+    "copy-into-beq",
+    "copy-into-imm-op",
+    "copy-into-reg-op",
+    "tail-call",
+    "xor-into-beq",
+    "zero-into-branch",
+]
+
+
+class Optimizer(object):
+    RA = 1
+    RSP = 2
+    DC = 3
+    DSP = 4
+    D0 = 5
+    D1 = 6
+    D2 = 7
+    D3 = 8
+    D4 = 9
+    D5 = 10
+    D6 = 11
+    D7 = 12
+    GP = 31
+
+    def __init__(self, trace=True, stats_file=None, peephole=True, disabled_rules=()):
+        # When set, optimize() prints the cached data stack on every call.
+        self.trace = trace
+        # When clear, optimize() leaves the code exactly as the primitives
+        # generated it.  Useful as a reference to test the rules against.
+        self.peephole = peephole
+        # Names of rules optimize() must not apply, to measure what each
+        # one is worth.
+        self.disabled_rules = set(disabled_rules)
+        # When set, finish() writes statistics for each subroutine here as
+        # one line of JSON.
+        self.stats_file = stats_file
+        self.reset()
+
+    def reset(self):
+        self.C = LiteralPool()
+        self.I = []
+        self.regs_rstack = []
+        self.rsp_offset = 0
+        self.regs_avail = [self.D0, self.D1, self.D2, self.D3, self.D4, self.D5, self.D6, self.D7]
+        self.gp_anchor = None
+        self.reset_dstack()
+        self.ctrl = []
+        # Generated labels are numbered by each Optimizer, so its code
+        # doesn't depend on what else the process has compiled.
+        self.labels_made = 0
+        self.current_subroutine = None
+        self.stats = self.new_statistics()
+        self.subroutine_stats = self.new_statistics()
+        self.reports = []
+
+    def new_label(self):
+        self.labels_made = self.labels_made + 1
+        # No identifier starts with a dot, so these can't clash with the
+        # names of subroutines.
+        return Label(".L{}".format(self.labels_made), local=True)
+
+    def new_statistics(self):
+        return {
+            "instructions": 0,
+            "rules": {},
+            "spills": 0,
+            "reloads": 0,
+            "literals": 0,
+            "registers": 0,
+            "loads removed": 0,
+            "stores removed": 0,
+            "stalls hidden": 0,
+        }
+
+    def count(self, key, n=1):
+        self.stats[key] = self.stats[key] + n
+        self.subroutine_stats[key] = self.subroutine_stats[key] + n
+
+    def enabled(self, rule):
+        return rule not in self.disabled_rules
+
+    def fired(self, rule):
+        for s in [self.stats, self.subroutine_stats]:
+            s["rules"][rule] = s["rules"].get(rule, 0) + 1
+
+    def note_registers(self):
+        n = len(self.regs_dstack) + len(self.regs_rstack)
+        for s in [self.stats, self.subroutine_stats]:
+            s["registers"] = max(s["registers"], n)
+
+    def statistics(self):
+        """
+        Counters accumulated since the last reset: instructions in the
+        program, peephole rules fired (per rule), stack items spilled to and
+        reloaded from memory, literal pool entries, the most registers ever
+        caching stack items at once, and loads and stores removed by
+        eliminate_stack_traffic().
+        """
+        stats = dict(self.stats)
+        stats["rules"] = dict(self.stats["rules"])
+        stats["instructions"] = code_size(self.I) // 4
+        return stats
+
+    def report(self):
+        """
+        Sets the current subroutine's statistics aside, for the passes over
+        finished code to add to and write_reports() to write, and starts
+        counting afresh for the next.
+        """
+        if self.current_subroutine is not None:
+            self.subroutine_stats["subroutine"] = self.current_subroutine.name
+            self.reports.append(self.subroutine_stats)
+        self.subroutine_stats = self.new_statistics()
+
+    def add_to_reports(self, key, counts):
+        """Adds counts, keyed by subroutine, to key in the set-aside statistics."""
+        for stats in self.reports:
+            stats[key] = stats[key] + counts.get(stats["subroutine"], 0)
+
+    def write_reports(self):
+        """
+        Writes the set-aside statistics to the stats file, if there is one,
+        counting each subroutine's instructions as they stand now.
+        """
+        sizes = {}
+        name = None
+        for i in self.I:
+            if i.op == OP_LABEL and not i.local:
+                name = i.name
+            elif i.op != OP_LABEL:
+                sizes[name] = sizes.get(name, 0) + 1
+        for stats in self.reports:
+            stats["instructions"] = sizes.get(stats["subroutine"], 0)
+            if self.stats_file is not None:
+                self.stats_file.write(json.dumps(stats, sort_keys=True) + "\n")
+        self.reports = []
+
+    def reset_dstack(self):
+        self.regs_dstack = [self.DC]
+        self.dsp_offset = 0
+        if self.DC in self.regs_avail:
+            self.regs_avail.remove(self.DC)
+
+    def refill_register(self):
+        if len(self.regs_avail) > 0:
+            r = self.regs_avail[0]
+            self.regs_dstack.append(r)
+            self.regs_avail = self.regs_avail[1:]
+            self.note_registers()
+            return r
+        raise Exception("Out of registers")
+
+    def next_register(self):
+        if len(self.regs_avail) > 0:
+            r = self.regs_avail[0]
+            self.regs_dstack.insert(0, r)
+            self.regs_avail = self.regs_avail[1:]
+            self.note_registers()
+            return r
+        raise Exception("Out of registers")
+
+    def free_register(self, r):
+        self.regs_avail.insert(0, r)
+
+    def pop_register(self):
+        r = self.regs_dstack[0]
+        self.free_register(r)
+        self.regs_dstack = self.regs_dstack[1:]
+        return r
+
+    def bind_s(self):
+        r = self.refill_register()
+        self.I.append(LD(r, self.dsp_offset, self.DSP))
+        self.dsp_offset = self.dsp_offset + 8
+        self.count("reloads")
+
+    def commit_stack(self):
+        if len(self.regs_dstack) < 2:
+            return
+
+        regs = self.regs_dstack[1:]
+        regs.reverse()
+        for r in regs:
+            self.dsp_offset = self.dsp_offset - 8
+            self.I.append(SD(r, self.dsp_offset, self.DSP))
+            self.count("spills")
+            if r != self.DC:
+                self.free_register(r)
+
+    def commit_stack_cache(self):
+        r = self.regs_dstack[0]
+        self.I.append(ORI(self.DC, r, 0))
+        self.free_register(r)
+
+    def commit(self):
+        self.commit_stack()
+
+        if (len(self.regs_dstack) >= 1) and (self.regs_dstack[0] != self.DC):
+            self.commit_stack_cache()
+        elif len(self.regs_dstack) == 0:
+            self.I.append(LD(self.DC, self.dsp_offset, self.DSP))
+            self.dsp_offset = self.dsp_offset + 8
+
+        if self.dsp_offset != 0:
+            self.I.append(ADDI(self.DSP, self.DSP, self.dsp_offset))
+            self.dsp_offset = 0
+
+        self.reset_dstack()
+
+    def literal(self, n):
+        if fits_imm12(n):
+            r = self.next_register()
+            self.I.append(ORI(r, 0, n))
+            return
+
+        hi, lo = hi20_lo12(n)
+        synthesized = 1 + (lo != 0)
+        if fits_imm20(hi) and synthesized <= self.pool_cost(n):
+            r = self.next_register()
+            self.I.append(LUI(r, hi))
+            if lo != 0:
+                self.I.append(ADDI(r, r, lo))
+            return
+
+        if n not in self.C:
+            self.count("literals")
+        self.fetch_variable(self.C.slot(n))
+
+    def variable(self):
+        """
+        Returns a new literal pool slot to use as a variable, with
+        fetch_variable() and store_variable().
+        """
+        return self.C.variable()
+
+    def pool_offset(self, slot):
+        """GP's displacement to slot, setting up a new anchor if need be."""
+        offset = self.anchor_offset(slot)
+        if offset is None:
+            self.new_anchor(slot)
+            offset = self.anchor_offset(slot)
+        return offset
+
+    def fetch_variable(self, slot):
+        i = LD(self.next_register(), self.pool_offset(slot), self.GP)
+        i.pool_slot = slot
+        i.anchor = self.gp_anchor
+        self.I.append(i)
+
+    def store_variable(self, slot):
+        if len(self.regs_dstack) < 1:
+            self.bind_s()
+        offset = self.pool_offset(slot)
+        i = SD(self.pop_register(), offset, self.GP)
+        i.pool_slot = slot
+        i.anchor = self.gp_anchor
+        self.I.append(i)
+
+    def address(self, name):
+        """Pushes the address of the label with the given name."""
+        r = self.next_register()
+        a = AUIPC(r, 0)
+        a.target = Label(name)
+        i = ADDI(r, r, 0)
+        i.anchor = a
+        self.I.append(a)
+        self.I.append(i)
+
+    def pool_cost(self, n):
+        """
+        Cost, in 32-bit words of program image, of loading n from the literal
+        pool: the LD itself, plus an AUIPC if the current anchor can't reach
+        n's slot, plus the slot itself if n isn't pooled yet.
+        """
+        if n in self.C:
+            reachable = self.anchor_offset(self.C.slots[n]) is not None
+            return 1 + (not reachable)
+        return 1 + 1 + 2
+
+    def anchor_offset(self, slot):
+        """
+        Displacement from the current GP anchor to the given pool slot, or
+        None if there's no anchor or the slot lies out of 12-bit reach.
+        """
+        if self.gp_anchor is None:
+            return None
+        a = self.gp_anchor
+        offset = self.C.address(slot) - (a.pc + (a.imm20 << 12))
+        if fits_imm12(offset):
+            return offset
+        return None
+
+    def new_anchor(self, slot):
+        pc = code_size(self.I)
+        hi, lo = hi20_lo12(self.C.address(slot) - pc)
+        a = AUIPC(self.GP, hi)
+        a.pc = pc
+        a.pool_slot = slot
+        self.I.append(a)
+        self.gp_anchor = a
+
+    def invalidate_anchor(self):
+        """
+        GP is only known to hold an anchor along straight-line code following
+        its AUIPC.  Control can reach a label from elsewhere, and a callee
+        sets GP up for its own literals.
+        """
+        self.gp_anchor = None
+
+    def relocate(self):
+        """
+        Recomputes every anchor, pool displacement and label address from
+        the current instruction positions, after later passes have moved
+        code around.
+        """
+        labels = label_addresses(self.I, 0)
+
+        pc = 0
+        for i in self.I:
+            if i.op == OP_LABEL:
+                continue
+            if i.op == OP_AUIPC and hasattr(i, "pool_slot"):
+                i.pc = pc
+                i.imm20, lo = hi20_lo12(self.C.address(i.pool_slot) - pc)
+            elif i.op == OP_AUIPC and hasattr(i, "target"):
+                if i.target.name not in labels:
+                    raise Exception("Undefined label {}".format(i.target.name))
+                i.pc = pc
+                i.imm20, lo = hi20_lo12(labels[i.target.name] - pc)
+            elif i.op in (OP_LD, OP_SD) and hasattr(i, "pool_slot"):
+                a = i.anchor
+                i.offset = self.C.address(i.pool_slot) - (a.pc + (a.imm20 << 12))
+                if not fits_imm12(i.offset):
+                    raise Exception("Literal pool slot out of reach of its anchor")
+            elif i.op == OP_ADDI and hasattr(i, "anchor"):
+                a = i.anchor
+                i.imm12 = labels[a.target.name] - (a.pc + (a.imm20 << 12))
+            pc = pc + 4
+
+    def alu(self, cls):
+        if len(self.regs_dstack) >= 2:
+            rd = self.regs_dstack[1]
+            rs = self.pop_register()
+            self.I.append(cls(rd, rd, rs))
+        else:
+            self.bind_s()
+            self.alu(cls)
+
+    def xor(self):
+        self.alu(XOR)
+
+    def And(self):
+        self.alu(AND)
+
+    def Or(self):
+        self.alu(OR)
+
+    def add(self):
+        self.alu(ADD)
+
+    def sub(self):
+        self.alu(SUB)
+
+    def mul(self):
+        self.alu(MUL)
+
+    def lshift(self):
+        self.alu(SLL)
+
+    def rshift(self):
+        self.alu(SRL)
+
+    def arshift(self):
+        self.alu(SRA)
+
+    def cfetch(self):
+        if len(self.regs_dstack) >= 1:
+            rd = self.regs_dstack[0]
+            self.I.append(LB(rd, 0, rd))
+        else:
+            self.bind_s()
+            self.cfetch()
+
+    def cstore(self):
+        if len(self.regs_dstack) >= 2:
+            rs = self.regs_dstack[1]
+            rd = self.regs_dstack[0]
+            self.I.append(SB(rs, 0, rd))
+            self.pop_register()
+            self.pop_register()
+        else:
+            self.bind_s()
+            self.cstore()
+
+    def fetch(self):
+        if len(self.regs_dstack) >= 1:
+            rd = self.regs_dstack[0]
+            self.I.append(LD(rd, 0, rd))
+        else:
+            self.bind_s()
+            self.fetch()
+
+    def store(self):
+        if len(self.regs_dstack) >= 2:
+            rs = self.regs_dstack[1]
+            rd = self.regs_dstack[0]
+            self.I.append(SD(rs, 0, rd))
+            self.pop_register()
+            self.pop_register()
+        else:
+            self.bind_s()
+            self.store()
+
+    def push(self):
+        if len(self.regs_dstack) >= 1:
+            r = self.regs_dstack[0]
+            self.regs_dstack = self.regs_dstack[1:]
+            self.regs_rstack.insert(0, r)
+        else:
+            self.bind_s()
+            self.push()
+
+    def pop(self):
+        if len(self.regs_rstack) >= 1:
+            r = self.regs_rstack[0]
+            self.regs_rstack = self.regs_rstack[1:]
+            self.regs_dstack.insert(0, r)
+        else:
+            r = self.refill_register()
+            self.I.append(LD(r, self.rsp_offset, self.RSP))
+            self.rsp_offset = self.rsp_offset + 8
+            
+    def dup(self):
+        if len(self.regs_dstack) >= 1:
+            r = self.regs_dstack[0]
+            self.I.append(ORI(self.next_register(), r, 0))
+        else:
+            self.bind_s()
+            self.dup()
+
+    def swap(self):
+        if len(self.regs_dstack) >= 2:
+            t = self.regs_dstack[0]
+            self.regs_dstack[0] = self.regs_dstack[1]
+            self.regs_dstack[1] = t
+        else:
+            self.bind_s()
+            self.swap()
+
+    def over(self):
+        if len(self.regs_dstack) >= 2:
+            rs = self.regs_dstack[1]
+            rd = self.next_register()
+            self.I.append(ORI(rd, rs, 0))
+        else:
+            self.bind_s()
+            self.over()
+
+    def drop(self):
+        if len(self.regs_dstack) >= 1:
+            self.pop_register()
+        else:
+            self.dsp_offset = self.dsp_offset + 8
+
+    def nip(self):
+        self.swap(); self.optimize()
+        self.drop(); self.optimize()
+
+
+    def div2(self):
+        self.arshift_imm(1)
+
+    def mul2(self):
+        self.lshift_imm(1)
+
+    def alu_imm(self, cls, imm):
+        if len(self.regs_dstack) >= 1:
+            rd = self.regs_dstack[0]
+            self.I.append(cls(rd, rd, imm))
+        else:
+            self.bind_s()
+            self.alu_imm(cls, imm)
+
+    def add_imm(self, imm):
+        self.alu_imm(ADDI, imm)
+
+    def xor_imm(self, imm):
+        self.alu_imm(XORI, imm)
+
+    def and_imm(self, imm):
+        self.alu_imm(ANDI, imm)
+
+    def or_imm(self, imm):
+        self.alu_imm(ORI, imm)
+
+    def lshift_imm(self, n):
+        self.alu_imm(SLLI, n & 63)
+
+    def rshift_imm(self, n):
+        self.alu_imm(SRLI, n & 63)
+
+    def arshift_imm(self, n):
+        self.alu_imm(SRAI, n & 63)
+
+    def negate(self):
+        if len(self.regs_dstack) >= 1:
+            rd = self.regs_dstack[0]
+            self.I.append(SUB(rd, 0, rd))
+        else:
+            self.bind_s()
+            self.negate()
+
+    def zero_equal(self):
+        """Replaces the top of the stack with -1 if it's zero, else 0."""
+        self.alu_imm(SLTIU, 1); self.optimize()
+        self.negate()
+
+    def zero_unequal(self):
+        """Replaces the top of the stack with 0 if it's zero, else -1."""
+        if len(self.regs_dstack) >= 1:
+            rd = self.regs_dstack[0]
+            self.I.append(SLTU(rd, 0, rd)); self.optimize()
+            self.negate()
+        else:
+            self.bind_s()
+            self.zero_unequal()
+
+    def mul_imm(self, k):
+        if len(self.regs_dstack) < 1:
+            self.bind_s()
+            self.mul_imm(k)
+            return
+
+        rd = self.regs_dstack[0]
+        seq = None
+        if len(self.regs_avail) > 0:
+            seq = mul_sequence(rd, self.regs_avail[0], k)
+        if seq is None:
+            self.literal(k)
+            self.mul()
+        else:
+            self.I.extend(seq)
+
+    def subroutine(self, name):
+        self.commit(); self.optimize()
+        if self.current_subroutine is not None:
+            self.report()
+        self.invalidate_anchor()
+        l = Label(name)
+        self.I.append(l)
+        self.current_subroutine = l
+
+    def rfs(self):
+        self.commit(); self.optimize()
+        self.I.append(JALR(0, 0, self.RA))
+
+    def If(self):
+        if len(self.regs_dstack) < 1:
+            self.bind_s()
+
+        r = self.pop_register()
+
+        l = self.new_label()
+        self.ctrl.insert(0, (l, list(self.regs_dstack), self.dsp_offset))
+        self.I.append(BEQ(r, 0, l))
+
+    def if_equal(self):
+        """
+        Like If, but pops two items, and skips to the matching Then
+        unless they're equal.  That takes one branch, where comparing
+        them first and then testing the flag would take two.
+        """
+        self.if_compare(BNE)
+
+    def if_unequal(self):
+        """Like if_equal, but skips unless the two items differ."""
+        self.if_compare(BEQ)
+
+    def if_compare(self, cls):
+        if len(self.regs_dstack) < 2:
+            self.bind_s()
+            self.if_compare(cls)
+            return
+
+        r2 = self.pop_register()
+        r1 = self.pop_register()
+
+        l = self.new_label()
+        self.ctrl.insert(0, (l, list(self.regs_dstack), self.dsp_offset))
+        self.I.append(cls(r1, r2, l))
+
+    def Then(self):
+        l, regs, dsp_offset = self.ctrl[0]
+        self.ctrl = self.ctrl[1:]
+
+        if len(self.I) > 0 and self.is_jump(self.I[-1]):
+            self.adopt(regs, dsp_offset)
+        else:
+            self.merge(regs, dsp_offset); self.optimize()
+        self.invalidate_anchor()
+        self.I.append(l)
+
+    def adopt(self, regs, dsp_offset):
+        self.regs_dstack = list(regs)
+        self.dsp_offset = dsp_offset
+        used = self.regs_dstack + self.regs_rstack
+        everything = [self.D0, self.D1, self.D2, self.D3, self.D4, self.D5, self.D6, self.D7, self.DC]
+        self.regs_avail = [r for r in everything if r not in used]
+
+    def merge(self, regs, dsp_offset):
+        """
+        Brings the stack cache into the layout it had when a forward branch
+        was taken, so control reaches the branch target with the same
+        registers caching the same stack items along either path, and
+        nothing needs spilling or reloading across the join.
+        """
+        while len(self.regs_dstack) > len(regs):
+            r = self.regs_dstack[-1]
+            self.regs_dstack = self.regs_dstack[:-1]
+            self.dsp_offset = self.dsp_offset - 8
+            self.I.append(SD(r, self.dsp_offset, self.DSP))
+            self.count("spills")
+            self.free_register(r)
+
+        while len(self.regs_dstack) < len(regs):
+            self.bind_s()
+
+        if self.dsp_offset != dsp_offset:
+            self.I.append(ADDI(self.DSP, self.DSP, self.dsp_offset - dsp_offset))
+
+        self.move_registers(list(zip(regs, self.regs_dstack)))
+        self.adopt(regs, dsp_offset)
+
+    def move_registers(self, moves):
+        """
+        Performs the (destination, source) register moves as if all at
+        once.  Cycles are broken through a free register, or by exchanging
+        registers in place when none is free.
+        """
+        moves = [(d, s) for d, s in moves if d != s]
+        # Registers already given their final values, which regs_avail may
+        # still list as free.
+        done = []
+        while len(moves) > 0:
+            sources = [s for d, s in moves]
+            ready = [m for m in moves if m[0] not in sources]
+            if len(ready) > 0:
+                d, s = ready[0]
+                self.I.append(ORI(d, s, 0))
+                moves.remove((d, s))
+                done.append(d)
+                continue
+
+            d, s = moves[0]
+            busy = [r for m in moves for r in m] + done
+            free = [r for r in self.regs_avail if r not in busy]
+            if len(free) > 0:
+                t = free[0]
+                self.I.append(ORI(t, s, 0))
+                moves = [(md, t if ms == s else ms) for md, ms in moves]
+            else:
+                self.I.append(XOR(d, d, s))
+                self.I.append(XOR(s, d, s))
+                self.I.append(XOR(d, d, s))
+                moves.remove((d, s))
+                # d and s have traded values, so moves reading either now
+                # read the other, and one of them may have become a no-op.
+                swapped = {d: s, s: d}
+                moves = [(md, swapped.get(ms, ms)) for md, ms in moves]
+                moves = [(md, ms) for md, ms in moves if md != ms]
+
+    def call(self, name):
+        self.commit(); self.optimize()
+        self.I.append(JAL(self.RA, Label(name)))
+        self.invalidate_anchor()
+
+    def jump(self, name):
+        self.commit(); self.optimize()
+        self.I.append(JAL(0, Label(name)))
+        self.invalidate_anchor()
+
+    def go(self, link=0):
+        """
+        Jumps to the address on top of the stack or, with link set to RA,
+        calls it.
+        """
+        if len(self.regs_dstack) < 1:
+            self.bind_s()
+        r = self.pop_register()
+        if r == self.DC:
+            # commit() is about to reload DC with the new top of stack.
+            t = [a for a in self.regs_avail if a != self.DC][0]
+            self.I.append(ORI(t, r, 0))
+            r = t
+        self.commit(); self.optimize()
+        self.I.append(JALR(link, 0, r))
+        self.invalidate_anchor()
+
+    def call_address(self):
+        self.go(self.RA)
+
+    def save_link(self):
+        """
+        Pushes RA on the return stack in memory, so code that calls others
+        can still return.  restore_link() pops it back.
+        """
+        self.commit(); self.optimize()
+        self.I.append(ADDI(self.RSP, self.RSP, -8))
+        self.I.append(SD(self.RA, 0, self.RSP))
+
+    def restore_link(self):
+        self.commit(); self.optimize()
+        self.I.append(LD(self.RA, 0, self.RSP))
+        self.I.append(ADDI(self.RSP, self.RSP, 8))
+
+    def recurse(self):
+        self.commit(); self.optimize()
+        self.I.append(JAL(self.RA, self.current_subroutine))
+        self.invalidate_anchor()
+
+    def optimize(self):
+        if self.trace:
+            print(self.regs_dstack)
+        if not self.peephole:
+            return
+        while self.optimize_step():
+            pass
+
+    def is_live(self, r):
+        """True if r caches a data or return stack item."""
+        return r in self.regs_dstack or r in self.regs_rstack
+
+    def dead_after(self, r, i):
+        """
+        True if nothing reads r once i, the last instruction emitted so far,
+        has executed.  Rules that delete the instruction setting r rely on
+        this.
+        """
+        return r in regs_written(i) or not self.is_live(r)
+
+    def optimize_step(self):
+        if len(self.I) >= 3:
+            i0 = self.I[-1]
+            i1 = self.I[-2]
+            i2 = self.I[-3]
+            if i0.op in FOLD and i1.is_small_const() and i2.is_small_const() and i1.dest != i2.dest and self.dead_after(i1.dest, i0) and self.dead_after(i2.dest, i0):
+                consts = {i1.dest: i1.imm12, i2.dest: i2.imm12}
+                if self.enabled("fold-constants") and i0.src1 in consts and i0.src2 in consts:
+                    n = signed64(FOLD[i0.op](consts[i0.src1], consts[i0.src2]))
+                    self.pop_register()
+                    self.I = self.I[:-3]
+                    self.literal(n)
+                    self.fired("fold-constants")
+                    return True
+
+        if len(self.I) >= 2:
+            i0 = self.I[-1]
+            i1 = self.I[-2]
+            if self.enabled("immediate-form") and i0.op in REG_OPS and i1.is_small_const() and self.fold_imm(i0, i1):
+                self.fired("immediate-form")
+                return True
+            elif self.enabled("copy-into-ld-base") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op == OP_LD and i0.index == i1.dest and self.dead_after(i1.dest, i0):
+                i = LD(i0.dest, i0.offset, i1.src1)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-ld-base")
+                return True
+            elif self.enabled("copy-into-sd-base") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op == OP_SD and i0.index == i1.dest and i0.src != i1.dest and self.dead_after(i1.dest, i0):
+                i = SD(i0.src, i0.offset, i1.src1)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-sd-base")
+                return True
+            elif self.enabled("copy-into-sd-value") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op == OP_SD and i0.src == i1.dest and i0.index != i1.dest and self.dead_after(i1.dest, i0):
+                i = SD(i1.src1, i0.offset, i0.index)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-sd-value")
+                return True
+            elif self.enabled("copy-into-lb-base") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op == OP_LB and i0.index == i1.dest and self.dead_after(i1.dest, i0):
+                i = LB(i0.dest, i0.offset, i1.src1)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-lb-base")
+                return True
+            elif self.enabled("copy-into-sb-base") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op == OP_SB and i0.index == i1.dest and i0.src != i1.dest and self.dead_after(i1.dest, i0):
+                i = SB(i0.src, i0.offset, i1.src1)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-sb-base")
+                return True
+            elif self.enabled("copy-into-sb-value") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op == OP_SB and i0.src == i1.dest and i0.index != i1.dest and self.dead_after(i1.dest, i0):
+                i = SB(i1.src1, i0.offset, i0.index)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-sb-value")
+                return True
+            elif self.enabled("copy-into-beq") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op == OP_BEQ and i0.src1 == i1.dest and i0.src2 != i1.dest and self.dead_after(i1.dest, i0):
+                i = BEQ(i1.src1, i0.src2, i0.label)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-beq")
+                return True
+            elif self.enabled("copy-into-imm-op") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op in (OP_ADDI, OP_XORI, OP_ANDI, OP_ORI, OP_SLLI, OP_SRLI, OP_SRAI) and i0.dest == i1.dest and i0.src1 == i1.dest:
+                i = type(i0)(i0.dest, i1.src1, i0.imm12)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-imm-op")
+                return True
+            elif self.enabled("copy-into-reg-op") and i1.op == OP_ORI and i1.imm12 == 0 and i0.op in REG_OPS and i0.dest == i0.src1 and i0.src2 == i1.dest and i0.dest != i1.dest and self.dead_after(i1.dest, i0):
+                i = type(i0)(i0.dest, i0.dest, i1.src1)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("copy-into-reg-op")
+                return True
+            elif self.enabled("tail-call") and i1.op == OP_JAL and i1.dest == self.RA and i0.op == OP_JALR and i0.dest == 0 and i0.offset == 0 and i0.index == self.RA:
+                i = JAL(0, i1.label)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("tail-call")
+                return True
+            elif self.enabled("xor-into-beq") and i1.op == OP_XOR and i1.dest == i1.src1 and i0.op == OP_BEQ and i0.src1 == i1.src1 and i0.src2 == 0 and self.dead_after(i1.dest, i0):
+                i = BEQ(i1.src1, i1.src2, i0.label)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("xor-into-beq")
+                return True
+            elif self.enabled("zero-into-branch") and i1.is_small_const() and i1.imm12 == 0 and i0.op in (OP_BEQ, OP_BNE) and i0.src2 == i1.dest and i0.src1 != i1.dest and self.dead_after(i1.dest, i0):
+                i = type(i0)(i0.src1, 0, i0.label)
+                self.I = self.I[:-2]
+                self.I.append(i)
+                self.fired("zero-into-branch")
+                return True
+        return False
+
+    def fold_imm(self, i0, i1):
+        """
+        Rewrites the register-register operation i0, one of whose operands
+        the small constant i1 just loaded, into an immediate form.  Returns
+        False if there's no cheaper form.
+        """
+        k = i1.imm12
+        if i0.src1 == i0.src2 or not self.dead_after(i1.dest, i0):
+            return False
+        if i0.src2 == i1.dest:
+            rs = i0.src1
+        elif i0.src1 == i1.dest and i0.op in COMMUTATIVE:
+            rs = i0.src2
+        else:
+            return False
+
+        if i0.op in IMM_OPS:
+            if i0.op in (OP_SLL, OP_SRL, OP_SRA):
+                if rs != i0.src1:
+                    return False
+                k = k & 63
+            i = IMM_OPS[i0.op](i0.dest, rs, k)
+            self.I = self.I[:-2]
+            self.I.append(i)
+            return True
+        elif i0.op == OP_SUB:
+            if not fits_imm12(-k):
+                return False
+            self.I = self.I[:-2]
+            self.I.append(ADDI(i0.dest, rs, -k))
+            return True
+        elif i0.op == OP_MUL:
+            # The scratch register mustn't be i0.dest or anything still
+            # live; rs may well be, once copy-into-reg-op has run.
+            if i1.dest != i0.dest:
+                t = i1.dest
+            elif self.dead_after(rs, i0):
+                t = rs
+            else:
+                free = [r for r in self.regs_avail if r != i0.dest and r != rs]
+                if len(free) == 0:
+                    return False
+                t = free[0]
+            seq = mul_sequence(i0.dest, t, k)
+            if seq is None:
+                return False
+            self.I = self.I[:-2]
+            if rs != i0.dest:
+                self.I.append(ORI(i0.dest, rs, 0))
+            self.I.extend(seq)
+            return True
+        return False
+
+    def flow_graph(self):
+        return cfg.build(self.I)
+
+    def eliminate_stack_traffic(self):
+        """
+        Removes loads and stores through DSP and RSP that can't matter, one
+        basic block at a time.  A load from a slot whose contents are still
+        known to be in a register becomes a register move (or disappears);
+        a store is deleted if the slot already holds that register, if it's
+        overwritten before anything could read it, or if the slot lies
+        below its stack pointer when the block ends.
+
+        Returns, per subroutine, how many loads and stores were removed.
+        """
+        report = {}
+        counts = None
+        g = self.flow_graph()
+        for b in g.blocks:
+            for l in b.labels:
+                if not l.local:
+                    counts = {"loads": 0, "stores": 0}
+                    report[l.name] = counts
+            if counts is None:
+                counts = {"loads": 0, "stores": 0}
+                report[None] = counts
+            b.insns = self.stack_traffic_in_block(b.insns, counts)
+        self.I = g.flatten()
+        for counts in report.values():
+            self.stats["loads removed"] = self.stats["loads removed"] + counts["loads"]
+            self.stats["stores removed"] = self.stats["stores removed"] + counts["stores"]
+        self.add_to_reports("loads removed", dict([(k, c["loads"]) for k, c in report.items()]))
+        self.add_to_reports("stores removed", dict([(k, c["stores"]) for k, c in report.items()]))
+        return report
+
+    def stack_traffic_in_block(self, insns, counts):
+        bases = [self.DSP, self.RSP]
+        known = {}      # (base, offset) -> registers holding the slot's value
+        unread = {}     # (base, offset) -> store nobody has read yet
+        dead = []
+        out = []
+
+        def overlapping(table, base, offset):
+            return [k for k in table if k[0] == base and abs(k[1] - offset) < 8]
+
+        def read_all():
+            unread.clear()
+
+        def finish():
+            for k, i in unread.items():
+                if k[1] < 0:
+                    dead.append(i)
+
+        for i in insns:
+            if i.op in (OP_SD, OP_SB) and i.index in bases:
+                key = (i.index, i.offset)
+                if i.op == OP_SD and i.src in known.get(key, ()):
+                    counts["stores"] = counts["stores"] + 1
+                    continue
+                for k in overlapping(known, i.index, i.offset):
+                    del known[k]
+                if key in unread and i.op == OP_SD:
+                    dead.append(unread[key])
+                for k in overlapping(unread, i.index, i.offset):
+                    del unread[k]
+                unread[key] = i
+                if i.op == OP_SD:
+                    known[key] = set([i.src])
+                out.append(i)
+                continue
+
+            if i.op in (OP_LD, OP_LB) and i.index in bases:
+                key = (i.index, i.offset)
+                regs = known.get(key)
+                if i.op == OP_LD and regs:
+                    counts["loads"] = counts["loads"] + 1
+                    if i.dest in regs:
+                        continue
+                    out.append(ORI(i.dest, min(regs), 0))
+                    for k in list(known.keys()):
+                        known[k].discard(i.dest)
+                    regs.add(i.dest)
+                    continue
+                else:
+                    for k in overlapping(unread, i.index, i.offset):
+                        del unread[k]
+            elif i.op in (OP_LD, OP_LB) and i.index != self.GP:
+                read_all()
+            elif i.op in (OP_SD, OP_SB):
+                known.clear()
+            elif i.op in (OP_JAL, OP_JALR, OP_BEQ, OP_BNE):
+                finish()
+                read_all()
+
+            for r in regs_written(i):
+                for k in list(known.keys()):
+                    known[k].discard(r)
+                    if len(known[k]) == 0:
+                        del known[k]
+                if r in bases:
+                    moved = i.op == OP_ADDI and i.src1 == r
+                    for table in [known, unread]:
+                        # Take every entry out before putting any back, or
+                        # one could land on another that hasn't moved yet.
+                        entries = [(k, table.pop(k)) for k in list(table.keys()) if k[0] == r]
+                        if moved:
+                            for k, v in entries:
+                                table[(r, k[1] - i.imm12)] = v
+
+            if i.op == OP_LD and i.index in bases and i.dest != i.index:
+                known[(i.index, i.offset)] = set([i.dest])
+            out.append(i)
+
+        if len(out) == 0 or out[-1].op not in (OP_JAL, OP_JALR, OP_BEQ, OP_BNE):
+            finish()
+
+        counts["stores"] = counts["stores"] + len(dead)
+        return [i for i in out if i not in dead]
+
+    def schedule(self, latency=None):
+        """
+        Reorders instructions within each basic block to keep results,
+        loaded values especially, away from their first use.  latency maps
+        op codes to result latencies, defaulting to LATENCY.
+
+        Returns, per subroutine, how many stall cycles were hidden.
+        """
+        if latency is None:
+            latency = LATENCY
+        report = {}
+        name = None
+        g = self.flow_graph()
+        for b in g.blocks:
+            for l in b.labels:
+                if not l.local:
+                    name = l.name
+            b.insns, before, after = schedule_block(b.insns, latency)
+            self.stats["stalls hidden"] = self.stats["stalls hidden"] + before - after
+            report[name] = report.get(name, 0) + before - after
+        self.I = g.flatten()
+        self.add_to_reports("stalls hidden", report)
+        return report
+
+    def is_jump(self, i):
+        return (i.op == OP_JAL or i.op == OP_JALR) and i.dest == 0
+
+    def cleanup(self):
+        """
+        Control-flow cleanup for finished code.  Threads branches and jumps
+        through jumps to jumps, deletes code made unreachable by an
+        unconditional transfer, inverts branches around a jump, and drops
+        jumps to the next instruction along with the generated labels
+        nothing refers to any more.
+        """
+        while self.cleanup_step():
+            pass
+
+    def cleanup_step(self):
+        labels = {}
+        for n, i in enumerate(self.I):
+            if i.op == OP_LABEL:
+                labels[i.name] = n
+
+        def destination(label):
+            n = labels.get(label.name)
+            if n is None:
+                return None
+            while n < len(self.I) and self.I[n].op == OP_LABEL:
+                n = n + 1
+            if n < len(self.I):
+                return self.I[n]
+            return None
+
+        def near(label, pc):
+            # Labels defined elsewhere might be anywhere.
+            return label.name in targets and fits_branch(targets[label.name] - pc)
+
+        changed = False
+
+        # Jump threading.  A branch reaches only 4 KiB either way, where a
+        # jump reaches 1 MiB, so a branch only takes over a jump's target
+        # if it's near enough.
+        pcs = addresses(self.I)
+        targets = label_addresses(self.I, 0)
+        for n, i in enumerate(self.I):
+            if i.op not in (OP_BEQ, OP_BNE, OP_JAL):
+                continue
+            d = destination(i.label)
+            if d is None:
+                continue
+            if d.op == OP_JAL and d.dest == 0 and d.label.name != i.label.name:
+                if i.op != OP_JAL and not near(d.label, pcs[n]):
+                    continue
+                i.label = d.label
+                changed = True
+            elif i.op == OP_JAL and i.dest == 0 and d.op == OP_JALR and d.dest == 0:
+                self.I[n] = JALR(0, d.offset, d.index)
+                changed = True
+
+        # Unreachable code following an unconditional transfer.
+        I = []
+        dead = False
+        for i in self.I:
+            if i.op == OP_LABEL:
+                dead = False
+            elif dead:
+                changed = True
+                continue
+            I.append(i)
+            dead = self.is_jump(i)
+        self.I = I
+
+        # Branches around jumps; branches and jumps to the next instruction.
+        # Deleting code only brings branches nearer their targets, so the
+        # addresses from before any of it was deleted are safe to check.
+        pcs = addresses(self.I)
+        targets = label_addresses(self.I, 0)
+        I = []
+        n = 0
+        while n < len(self.I):
+            i = self.I[n]
+            if i.op in (OP_BEQ, OP_BNE) and n+2 < len(self.I):
+                j = self.I[n+1]
+                l = self.I[n+2]
+                if j.op == OP_JAL and j.dest == 0 and l.op == OP_LABEL and l.name == i.label.name and near(j.label, pcs[n]):
+                    if i.op == OP_BEQ:
+                        I.append(BNE(i.src1, i.src2, j.label))
+                    else:
+                        I.append(BEQ(i.src1, i.src2, j.label))
+                    n = n + 2
+                    changed = True
+                    continue
+            if i.op in (OP_BEQ, OP_BNE, OP_JAL) and (i.op != OP_JAL or i.dest == 0):
+                m = n + 1
+                while m < len(self.I) and self.I[m].op == OP_LABEL and self.I[m].name != i.label.name:
+                    m = m + 1
+                if m < len(self.I) and self.I[m].op == OP_LABEL:
+                    n = n + 1
+                    changed = True
+                    continue
+            I.append(i)
+            n = n + 1
+        self.I = I
+
+        # Generated labels nobody branches to any more.
+        referenced = set([c[0].name for c in self.ctrl])
+        for i in self.I:
+            if i.op in (OP_BEQ, OP_BNE, OP_JAL):
+                referenced.add(i.label.name)
+        I = [i for i in self.I if i.op != OP_LABEL or not i.local or i.name in referenced]
+        if len(I) != len(self.I):
+            changed = True
+        self.I = I
+
+        return changed
+
+    def assemble(self):
+        self.relocate()
+        return assemble(self.I, self.C)
+
+    def listing(self):
+        self.relocate()
+        lines = ["\tDD\t{}".format(c) for c in self.C]
+        lines.extend([repr(i) for i in self.I])
+        lines.append("\n")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, f=None):
+        """
+        Writes the literal pool and program listing to the file-like f
+        (standard output by default) in a single write.
+        """
+        if f is None:
+            f = sys.stdout
+        f.write(self.listing())
+
+# Words of the driver's input language, one per line.  Numbers stand for
+# literals, and blank lines and lines starting with # are ignored.
+WORDS = {
+    "dup": Optimizer.dup,
+    "swap": Optimizer.swap,
+    "over": Optimizer.over,
+    "drop": Optimizer.drop,
+    "nip": Optimizer.nip,
+    "add": Optimizer.add,
+    "sub": Optimizer.sub,
+    "mul": Optimizer.mul,
+    "xor": Optimizer.xor,
+    "and": Optimizer.And,
+    "or": Optimizer.Or,
+    "lshift": Optimizer.lshift,
+    "rshift": Optimizer.rshift,
+    "arshift": Optimizer.arshift,
+    "div2": Optimizer.div2,
+    "mul2": Optimizer.mul2,
+    "fetch": Optimizer.fetch,
+    "store": Optimizer.store,
+    "cfetch": Optimizer.cfetch,
+    "cstore": Optimizer.cstore,
+    "push": Optimizer.push,
+    "pop": Optimizer.pop,
+    "if": Optimizer.If,
+    "then": Optimizer.Then,
+    "rfs": Optimizer.rfs,
+    "recurse": Optimizer.recurse,
+}
+
+# Words followed by an argument on the same line.
+NAMED_WORDS = {
+    "subroutine": Optimizer.subroutine,
+    "call": Optimizer.call,
+}
+
+NUMBERED_WORDS = {
+    "add_imm": Optimizer.add_imm,
+    "xor_imm": Optimizer.xor_imm,
+    "and_imm": Optimizer.and_imm,
+    "or_imm": Optimizer.or_imm,
+    "lshift_imm": Optimizer.lshift_imm,
+    "rshift_imm": Optimizer.rshift_imm,
+    "arshift_imm": Optimizer.arshift_imm,
+    "mul_imm": Optimizer.mul_imm,
+}
+
+
+def parse_number(text):
+    try:
+        return int(text, 0)
+    except ValueError:
+        return None
+
+
+def compile_line(o, line):
+    """Compiles one line of a program into o."""
+    words = line.split()
+    if len(words) == 0 or words[0].startswith("#"):
+        return
+
+    w = words[0]
+    n = parse_number(w)
+    if n is not None and len(words) == 1:
+        o.literal(n)
+    elif w in WORDS and len(words) == 1:
+        WORDS[w](o)
+    elif w in NAMED_WORDS and len(words) == 2:
+        NAMED_WORDS[w](o, words[1])
+    elif w in NUMBERED_WORDS and len(words) == 2 and parse_number(words[1]) is not None:
+        NUMBERED_WORDS[w](o, parse_number(words[1]))
+    else:
+        raise Exception("Can't compile {!r}".format(line.strip()))
+    o.optimize()
+
+
+def compile_file(o, f, name="<input>", first=1):
+    """
+    Compiles every line of the file-like f into o, which may already hold
+    other subroutines.  first is the line number f starts at.
+    """
+    for number, line in enumerate(f, first):
+        try:
+            compile_line(o, line)
+        except Exception as e:
+            raise Exception("{}:{}: {}".format(name, number, e))
+
+
+def finish(o, passes=True):
+    """
+    Ends the last subroutine compiled into o and, unless told otherwise,
+    runs the passes over finished code.
+    """
+    if len(o.ctrl) > 0:
+        raise Exception("if without then")
+    o.commit(); o.optimize()
+    o.report()
+    if passes:
+        o.eliminate_stack_traffic(); o.cleanup(); o.schedule()
+    o.write_reports()
+
+
+def split_subroutines(lines, name="<input>"):
+    """
+    Splits a program into (file name, first line number, lines) pieces that
+    each start at a subroutine word.  Anything ahead of the first one makes
+    a piece of its own.
+    """
+    pieces = []
+    start = 0
+    for n, line in enumerate(lines):
+        words = line.split()
+        if n > start and len(words) > 0 and words[0] == "subroutine":
+            pieces.append((name, start + 1, lines[start:n]))
+            start = n
+    if start < len(lines):
+        pieces.append((name, start + 1, lines[start:]))
+    return pieces
+
+
+def compile_piece(job):
+    """
+    Compiles one piece of split_subroutines() output with an Optimizer of
+    its own.  Runs in a worker process, so it returns only what merge()
+    needs: the instructions, the literal pool, and the statistics.
+    """
+    (name, first, lines), options, passes = job
+    o = Optimizer(trace=False, **options)
+    compile_file(o, lines, name, first)
+    finish(o, passes)
+    stats = o.statistics()
+    if o.current_subroutine is not None:
+        stats["subroutine"] = o.current_subroutine.name
+    return o.I, o.C, stats
+
+
+def merge(results):
+    """
+    Joins separately compiled pieces into one Optimizer, in the order given,
+    so the result doesn't depend on which worker finished first.
+
+    Each piece's literal pool keeps its slots together and in order, since
+    its anchors only reach so far; a piece reuses slots already in the
+    merged pool only where they hold the very same run of constants.
+    Generated labels are renumbered in program order.
+    """
+    o = Optimizer(trace=False)
+    for I, C, stats in results:
+        values = C.values
+        base = None
+        if len(values) > 0:
+            for start in range(len(o.C.values) - len(values) + 1):
+                if o.C.values[start:start+len(values)] == values:
+                    base = start
+                    break
+        if base is None:
+            base = len(o.C.values)
+            for n in values:
+                o.C.slots.setdefault(n, len(o.C.values))
+                o.C.values.append(n)
+
+        for i in I:
+            if i.op in (OP_AUIPC, OP_LD, OP_SD) and hasattr(i, "pool_slot"):
+                i.pool_slot = i.pool_slot + base
+        o.I.extend(I)
+
+        for key, n in stats.items():
+            if key == "rules":
+                for rule, fired in n.items():
+                    o.stats["rules"][rule] = o.stats["rules"].get(rule, 0) + fired
+            elif key == "registers":
+                o.stats[key] = max(o.stats[key], n)
+            elif key in o.stats:
+                o.stats[key] = o.stats[key] + n
+
+    n = 0
+    for i in o.I:
+        if i.op == OP_LABEL and i.local:
+            n = n + 1
+            i.name = ".L{}".format(n)
+    return o
+
+
+def compile_parallel(pieces, jobs=None, options={}, passes=True):
+    """
+    Compiles split_subroutines() pieces across a pool of jobs worker
+    processes (one per CPU by default), and merges the results.  Returns
+    the merged Optimizer and each piece's statistics, in program order.
+    """
+    import multiprocessing
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(compile_piece, [(p, options, passes) for p in pieces])
+    finally:
+        pool.close()
+        pool.join()
+    return merge(results), [stats for I, C, stats in results]
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compiles stack-primitive programs, one word per line, to RISC-V.",
+    )
+    parser.add_argument("files", nargs="*", default=["-"],
+                        help="programs to compile together (default: standard input)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="where to write the listing (default: standard output)")
+    parser.add_argument("-b", "--binary",
+                        help="also write the assembled literal pool and code here")
+    parser.add_argument("--stats",
+                        help="write per-subroutine statistics here as JSON lines")
+    parser.add_argument("--trace", action="store_true",
+                        help="print the cached data stack after every word")
+    parser.add_argument("--no-peephole", dest="peephole", action="store_false",
+                        help="leave out the peephole rules")
+    parser.add_argument("--disable", metavar="RULE", action="append", default=[], choices=RULES,
+                        help="leave out one peephole rule; may be repeated")
+    parser.add_argument("--no-passes", dest="passes", action="store_false",
+                        help="leave out the passes over finished code")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="compile subroutines in this many processes (0: one per CPU)")
+    args = parser.parse_args(argv)
+
+    stats_file = None
+    if args.stats is not None:
+        stats_file = open(args.stats, "w")
+
+    try:
+        if args.jobs == 1:
+            o = Optimizer(trace=args.trace, stats_file=stats_file,
+                          peephole=args.peephole, disabled_rules=args.disable)
+            for name in args.files:
+                if name == "-":
+                    compile_file(o, sys.stdin, "<stdin>")
+                else:
+                    with open(name) as f:
+                        compile_file(o, f, name)
+            finish(o, args.passes)
+        else:
+            pieces = []
+            for name in args.files:
+                if name == "-":
+                    pieces.extend(split_subroutines(sys.stdin.readlines(), "<stdin>"))
+                else:
+                    with open(name) as f:
+                        pieces.extend(split_subroutines(f.readlines(), name))
+            options = {"peephole": args.peephole, "disabled_rules": args.disable}
+            o, stats = compile_parallel(pieces, args.jobs or None, options, args.passes)
+            if stats_file is not None:
+                for s in stats:
+                    if "subroutine" in s:
+                        stats_file.write(json.dumps(s, sort_keys=True) + "\n")
+    except Exception as e:
+        sys.stderr.write("{}: {}\n".format(parser.prog, e))
+        return 1
+    finally:
+        if stats_file is not None:
+            stats_file.close()
+
+    if args.output == "-":
+        o.dump()
+    else:
+        with open(args.output, "w") as f:
+            o.dump(f)
+
+    if args.binary is not None:
+        with open(args.binary, "wb") as f:
+            f.write(o.assemble())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
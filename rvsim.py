@@ -0,0 +1,247 @@
+"""
+A small RISC-V interpreter for the instructions the peephole code generator
+emits.  It runs lists of instruction objects directly, laid out exactly as
+assemble() would lay them out: the literal pool first, then the code.
+
+Besides running code it counts what it did: instructions executed, loads,
+stores, taken branches, and cycles on a simple in-order pipeline that
+stalls until the registers an instruction reads are ready.
+"""
+
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The cycle counts follow the code generator's own scheduling model.
+from peephole import LATENCY, MASK64, signed64
+
+
+FORMATS = {1: "<B", 8: "<Q"}
+
+
+def signed8(n):
+    n = n & 0xFF
+    if n & 0x80:
+        return n - 0x100
+    return n
+
+
+class SparseMemory(object):
+    """Memory that exists wherever something is stored.  Reads as zero elsewhere."""
+
+    def __init__(self):
+        self.bytes = {}
+
+    def load(self, addr, size):
+        n = 0
+        for k in reversed(range(size)):
+            n = (n << 8) | self.bytes.get((addr + k) & MASK64, 0)
+        return n
+
+    def store(self, addr, value, size):
+        for k in range(size):
+            self.bytes[(addr + k) & MASK64] = (value >> (8 * k)) & 0xFF
+
+
+class ArrayMemory(object):
+    """
+    A flat NumPy byte array of the given size, starting at address base.
+    Faster than SparseMemory for big workloads, but every access has to
+    fall inside it.
+    """
+
+    def __init__(self, base, size):
+        if numpy is None:
+            raise Exception("ArrayMemory needs NumPy")
+        self.base = base
+        self.bytes = numpy.zeros(size, dtype=numpy.uint8)
+
+    def offset(self, addr, size):
+        a = (addr & MASK64) - self.base
+        if a < 0 or a + size > len(self.bytes):
+            raise Exception("Address {:#x} out of range".format(addr & MASK64))
+        return a
+
+    def load(self, addr, size):
+        a = self.offset(addr, size)
+        return struct.unpack(FORMATS[size], self.bytes[a:a+size].tobytes())[0]
+
+    def store(self, addr, value, size):
+        a = self.offset(addr, size)
+        data = struct.pack(FORMATS[size], value & ((1 << (8 * size)) - 1))
+        self.bytes[a:a+size] = numpy.frombuffer(data, dtype=numpy.uint8)
+
+
+def new_counters():
+    return {
+        "instructions": 0,
+        "loads": 0,
+        "stores": 0,
+        "taken branches": 0,
+        "cycles": 0,
+    }
+
+
+# Returning to this address ends a call() into the program.
+EXIT = 4
+
+
+class Machine(object):
+    def __init__(self, insns, pool=(), origin=0x10000, memory=None, latency=None):
+        self.x = [0] * 32
+        if memory is None:
+            memory = SparseMemory()
+        self.memory = memory
+        if latency is None:
+            latency = LATENCY
+        self.latency = latency
+        self.code = {}
+        self.labels = {}
+        self.pc = None
+        self.reset_counters()
+
+        addr = origin
+        for c in pool:
+            self.store(addr, c, 8)
+            addr = addr + 8
+
+        for i in insns:
+            if i.opc == ":label:":
+                self.labels[i.name] = addr
+            else:
+                self.code[addr] = i
+                addr = addr + 4
+
+    def reset_counters(self):
+        """
+        Zeroes the counters: instructions executed, loads, stores, taken
+        branches (jumps included), and cycles, each of which issues one
+        instruction or waits on a result still in flight.
+        """
+        self.counters = new_counters()
+        self.ready = [0] * 32
+
+    def load(self, addr, size):
+        return self.memory.load(addr, size)
+
+    def store(self, addr, value, size):
+        self.memory.store(addr, value, size)
+
+    def get(self, r):
+        return self.x[r]
+
+    def set(self, r, value):
+        if r != 0:
+            self.x[r] = signed64(value)
+
+    def target(self, label):
+        if label.name not in self.labels:
+            raise Exception("Undefined label {}".format(label.name))
+        return self.labels[label.name]
+
+    def call(self, name, max_steps=1000000):
+        """
+        Runs the subroutine with the given label until it returns, with
+        registers and memory as the caller left them.
+        """
+        self.x[1] = EXIT
+        self.pc = self.labels[name]
+        steps = 0
+        while self.pc != EXIT:
+            if steps >= max_steps:
+                raise Exception("Gave up after {} steps".format(max_steps))
+            self.step()
+            steps = steps + 1
+
+    def step(self):
+        i = self.code.get(self.pc)
+        if i is None:
+            raise Exception("No instruction at {:#x}".format(self.pc))
+        next_pc = self.pc + 4
+        x = self.x
+        opc = i.opc
+        counters = self.counters
+
+        start = counters["cycles"]
+        for a in ("src1", "src2", "src", "index"):
+            if hasattr(i, a):
+                start = max(start, self.ready[getattr(i, a)])
+        counters["cycles"] = start + 1
+        counters["instructions"] = counters["instructions"] + 1
+        if opc in ("ld", "lb"):
+            counters["loads"] = counters["loads"] + 1
+        elif opc in ("sd", "sb"):
+            counters["stores"] = counters["stores"] + 1
+
+        if opc == "add":
+            self.set(i.dest, x[i.src1] + x[i.src2])
+        elif opc == "sub":
+            self.set(i.dest, x[i.src1] - x[i.src2])
+        elif opc == "xor":
+            self.set(i.dest, x[i.src1] ^ x[i.src2])
+        elif opc == "and":
+            self.set(i.dest, x[i.src1] & x[i.src2])
+        elif opc == "or":
+            self.set(i.dest, x[i.src1] | x[i.src2])
+        elif opc == "mul":
+            self.set(i.dest, x[i.src1] * x[i.src2])
+        elif opc == "sll":
+            self.set(i.dest, x[i.src1] << (x[i.src2] & 63))
+        elif opc == "srl":
+            self.set(i.dest, (x[i.src1] & MASK64) >> (x[i.src2] & 63))
+        elif opc == "sra":
+            self.set(i.dest, x[i.src1] >> (x[i.src2] & 63))
+        elif opc == "sltu":
+            self.set(i.dest, int((x[i.src1] & MASK64) < (x[i.src2] & MASK64)))
+        elif opc == "addi":
+            self.set(i.dest, x[i.src1] + i.imm12)
+        elif opc == "xori":
+            self.set(i.dest, x[i.src1] ^ i.imm12)
+        elif opc == "andi":
+            self.set(i.dest, x[i.src1] & i.imm12)
+        elif opc == "ori":
+            self.set(i.dest, x[i.src1] | i.imm12)
+        elif opc == "slli":
+            self.set(i.dest, x[i.src1] << i.imm12)
+        elif opc == "srli":
+            self.set(i.dest, (x[i.src1] & MASK64) >> i.imm12)
+        elif opc == "srai":
+            self.set(i.dest, x[i.src1] >> i.imm12)
+        elif opc == "sltiu":
+            self.set(i.dest, int((x[i.src1] & MASK64) < (i.imm12 & MASK64)))
+        elif opc == "lui":
+            self.set(i.dest, i.imm20 << 12)
+        elif opc == "auipc":
+            self.set(i.dest, self.pc + (i.imm20 << 12))
+        elif opc == "ld":
+            self.set(i.dest, self.load(x[i.index] + i.offset, 8))
+        elif opc == "lb":
+            self.set(i.dest, signed8(self.load(x[i.index] + i.offset, 1)))
+        elif opc == "sd":
+            self.store(x[i.index] + i.offset, x[i.src], 8)
+        elif opc == "sb":
+            self.store(x[i.index] + i.offset, x[i.src], 1)
+        elif opc == "beq":
+            if x[i.src1] == x[i.src2]:
+                next_pc = self.target(i.label)
+        elif opc == "bne":
+            if x[i.src1] != x[i.src2]:
+                next_pc = self.target(i.label)
+        elif opc == "jal":
+            self.set(i.dest, next_pc)
+            next_pc = self.target(i.label)
+        elif opc == "jalr":
+            t = (x[i.index] + i.offset) & ~1
+            self.set(i.dest, next_pc)
+            next_pc = t
+        else:
+            raise Exception("Can't execute {}".format(opc))
+
+        if hasattr(i, "dest") and i.dest != 0:
+            self.ready[i.dest] = start + self.latency.get(i.op, 1)
+        if opc in ("jal", "jalr") or next_pc != self.pc + 4:
+            counters["taken branches"] = counters["taken branches"] + 1
+        self.pc = next_pc
@@ -1,11 +1,49 @@
 #!/usr/bin/env python
 #
-# To see recognizer state changes:
-# 	python stpl.py | grep "^\["
-# To see just the compiled assembly listing:
-# 	python stpl.py | grep -v "^\["
-# To see both interleaved:
+# To see the compiled assembly listing:
 # 	python stpl.py
+# To see it interleaved with recognizer state changes:
+# 	python stpl.py --trace
+# To see just the recognizer state changes:
+# 	python stpl.py --trace | grep "^\["
+#
+# Without arguments it compiles the example program below.  Otherwise it
+# compiles the named files (- for standard input) one after another, as a
+# single program, writing the listing to standard output or to -o's file:
+# 	python stpl.py -o prog.s lib.stpl prog.stpl
+#
+# The parser turns the program into a small intermediate representation
+# and hands it to a code generator: S16X4 by default, or RISC-V, through
+# the peephole code generator's register-caching Optimizer (see stplrv.py):
+# 	python stpl.py -t riscv prog.stpl
+#
+# As a server, it answers compile requests, one JSON object per line, on
+# standard input and output or on a Unix socket, with a pool of worker
+# processes doing the compiling (see compilerequest for the requests):
+# 	python stpl.py --serve -j 4
+# 	python stpl.py --socket /tmp/stpl.sock
+
+import argparse
+import array
+import json
+import multiprocessing
+import os
+import re
+import signal
+import sys
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+try:
+	import socketserver
+except ImportError:
+	import SocketServer as socketserver
+
+import lalr
+import stplrv
 
 
 src = """
@@ -35,281 +73,697 @@ K_WORD = 1
 K_CHAR = 2
 K_NUMBER = 3
 K_KEYWORD = 4
-K_EXPR = 5
-K_IDLIST = 6
 
-symbol = ''
-kind = K_SPACE
-
-keywords = [
+keywords = set([
 	'let', 'goto', 'if', 'return', 'declare', 'call'
+])
+
+# One token per match: a word, a number, a run of spaces (any control
+# character counts as a space), or any other single character.
+tokenpattern = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)|([0-9]+)|([\x00-\x20]+)|(.)', re.S)
+
+class Sink(object):
+	"""
+	Buffers output lines, writing them to a file a chunk at a time rather
+	than one line at a time.
+	"""
+	def __init__(self, f, size=65536):
+		self.f = f
+		self.size = size
+		self.lines = []
+		self.pending = 0
+
+	def write(self, text):
+		self.lines.append(text)
+		self.pending = self.pending + len(text)
+		if self.pending >= self.size:
+			self.flush()
+
+	def flush(self):
+		self.f.write("".join(self.lines))
+		self.f.flush()
+		self.lines = []
+		self.pending = 0
+
+# The STPL grammar.  Each rule names the RecognizerStack method (prefixed with
+# on_) that builds its intermediate representation, if any; the value of a
+# rule without one is that of its first symbol.  Terminals are keywords,
+# punctuation, and WORD and NUMBER tokens.
+grammar = [
+	('program',	'',				None),
+	('program',	'program statement',		None),
+
+	('statement',	'WORD :',			'label'),
+	('statement',	'declare idlist ;',		'declare'),
+	('statement',	'let WORD = expr tail',		'let'),
+	('statement',	'let ! primary = expr tail',	'store'),
+	('statement',	'goto expr tail',		'goto'),
+	('statement',	'call expr tail',		'call'),
+	('statement',	'return tail',			'ret'),
+
+	# Statements end in any number of conditions, innermost last.
+	('tail',	';',				'endtail'),
+	('tail',	'if expr tail',			'conditional'),
+
+	('idlist',	'WORD',				'idlist'),
+	('idlist',	'idlist , WORD',		'idlist_more'),
+
+	# All binary operators have the same precedence, and associate left.
+	('expr',	'primary',			None),
+	('expr',	'expr + primary',		'binary'),
+	('expr',	'expr & primary',		'binary'),
+	('expr',	'expr ~ primary',		'binary'),
+	('expr',	'expr ^ primary',		'binary'),
+	('expr',	'expr ! primary',		'binary'),
+	('expr',	'expr - primary',		'binary'),
+	('expr',	'expr = primary',		'binary'),
+	('expr',	'expr # primary',		'binary'),
+
+	('primary',	'NUMBER',			'number'),
+	('primary',	'WORD',				'variable'),
+	('primary',	'( expr )',			'parens'),
+	('primary',	'! primary',			'fetch'),
 ]
 
-procs = []
+# Parse tables are rebuilt only when the grammar changes.
+tablefile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stpl.tables')
+tables = lalr.load(grammar, tablefile)
 
-nextlabel = 0
-def alloclabel():
-	global nextlabel
-	l = nextlabel
-	nextlabel = nextlabel+1
-	return l
+def terminal(s, t):
+	if t == K_WORD:
+		return 'WORD'
+	if t == K_NUMBER:
+		return 'NUMBER'
+	return s
 
 class RecognizerStack(object):
-	def __init__(self):
-		self.s = []
-		self.t = []
-		self.nextlinelabel = None
-		self.context = None
-
-	def snarf(self, starting, length):
-		if len(self.s) - length <= 0:
-			self.s = []
-			self.t = []
+	"""
+	The parser's stack holds just states, which stand for their symbols
+	too (see lalr.Tables), and the symbols' values.  With trace set it
+	shows the stack before every step.
+	"""
+	def __init__(self, compiler, trace=False):
+		self.emit = compiler.emit
+		self.statement = compiler.statement
+		self.tracing = trace
+		self.states = array.array('i', [0])
+		self.values = []
+		self.recovering = False
+
+		# For each production: what it reduces to, how many symbols it
+		# pops, and the method generating its code, if any.
+		self.reductions = []
+		for lhs, rhs, action in tables.productions:
+			method = None
+			if action:
+				method = getattr(self, 'on_' + action)
+			self.reductions.append((lhs, len(rhs), method))
+
+	def trace(self):
+		symbols = [tables.symbol[s] for s in self.states[1:]]
+		self.emit("%s %s" % (symbols, list(self.states)))
+
+	def reduceby(self, p):
+		lhs, n, method = self.reductions[p]
+		if n > 0:
+			values = self.values[-n:]
+			del self.states[-n:]
+			del self.values[-n:]
+		else:
+			values = []
+		if method:
+			value = method(*values)
+		elif n > 0:
+			value = values[0]
 		else:
-			org = len(self.s)+starting
-			del self.s[org:org+length]
-			del self.t[org:org+length]
-
-	def reducestep(self):
-		print self.s, self.t
-
-		# let word =
-		if (len(self.s) > 2) and (self.t[-3] == K_KEYWORD) and (self.s[-3] == 'let') and (self.t[-2] == K_WORD) and (self.t[-1] == K_CHAR) and (self.s[-1] == '='):
-			self.context = None
-
-		# let word = expr ;
-		if (len(self.s) > 4) and (self.t[-5] == K_KEYWORD) and (self.s[-5] == 'let') and (self.t[-4] == K_WORD) and (self.t[-3] == K_CHAR) and (self.s[-3] == '=') and (self.t[-2] == K_EXPR) and (self.t[-1] == K_CHAR) and (self.s[-1] == ';'):
-			print "  lit " + self.s[-4]
-			print "  swm"
-			self.snarf(-5, 5)
-			return True
-
-		# let ! -- change context back, so that we can properly evaluate the target lvalue.
-		if (len(self.s) > 1) and (self.t[-2] == K_KEYWORD) and (self.s[-2] == 'let') and (self.t[-1] == K_CHAR) and (self.s[-1] == '!'):
-			self.context = None
-			return False
-
-		# let ! expr = expr ;
-		if (len(self.s) > 5) and (self.t[-6] == K_KEYWORD) and (self.s[-6] == 'let') and (self.t[-5] == K_CHAR) and (self.s[-5] == '!') and (self.t[-4] == K_EXPR) and (self.t[-3] == K_CHAR) and (self.s[-3] == '=') and (self.t[-2] == K_EXPR) and (self.t[-1] == K_CHAR) and (self.s[-1] == ';'):
-			print "  swap"
-			print "  swm"
-			self.snarf(-6, 6)
-			return True
-
-		# !! expr op expr
-		if (len(self.s) > 3) and ((self.t[-4] != K_CHAR) or (self.s[-4] != '!')) and (self.t[-3] == K_EXPR) and (self.t[-2] == K_CHAR) and (self.t[-1] == K_EXPR):
-			if self.s[-2] == '+':
-				print "  add"
-				self.snarf(-3, 2)
-			elif self.s[-2] == '&':
-				print "  and"
-				self.snarf(-3, 2)
-			elif self.s[-2] == '~':
-				print "  cpl"
-				self.snarf(-3, 2)
-			elif self.s[-2] == '^':
-				print "  xor"
-				self.snarf(-3, 2)
-			elif self.s[-2] == '!':
-				print "  add"
-				print "  fwm"
-				self.snarf(-3, 2)
-			elif self.s[-2] == "-":
-				print "  neg"
-				self.snarf(-3, 2)
-			elif self.s[-2] == '=':
-				print "  xor"
-				l1 = alloclabel()
-				l2 = alloclabel()
-				print "  zgo L%d" % l1
-				print "  lit 0"
-				print "  go  L%d\n  go" % l2
-				print "L%d:" % l1
-				print "  lit $FFFF"
-				print "L%d:" % l2
-				self.snarf(-3, 2)
-			elif self.s[-2] == '#':
-				print "  xor"
-				l1 = alloclabel()
-				l2 = alloclabel()
-				print "  zgo L%d" % l1
-				print "  lit $FFFF"
-				print "  go  L%d\n  go" % l2
-				print "L%d:" % l1
-				print "  lit 0"
-				print "L%d:" % l2
-				self.snarf(-3, 2)
+			value = None
+		self.states.append(tables.goto[self.states[-1]][lhs])
+		self.values.append(value)
+
+	def reducedefaults(self):
+		p = tables.default[self.states[-1]]
+		while p is not None:
+			if self.tracing:
+				self.trace()
+			self.reduceby(p)
+			p = tables.default[self.states[-1]]
+
+	def parse(self, a, value):
+		while True:
+			if self.tracing:
+				self.trace()
+			action = tables.action[self.states[-1]].get(a)
+			if action is None:
+				self.error(a)
+				return
+			if action[0] == 's':
+				self.states.append(action[1])
+				self.values.append(value)
+				self.reducedefaults()
+				return
+			if action[0] == 'r':
+				self.reduceby(action[1])
 			else:
-				print "SYNTAX ERROR: unsupported operator?"
-
-		# ( expr )
-		if (len(self.s) > 2) and (self.t[-3] == K_CHAR) and (self.s[-3] == '(') and (self.t[-2] == K_EXPR) and (self.t[-1] == K_CHAR) and (self.s[-1] == ')'):
-			self.snarf(-3, 1)
-			self.snarf(-1, 1)
-			return True
-
-		# (!expr && !let) ! expr
-		if (len(self.s) > 2) and (self.t[-3] != K_EXPR) and ((self.t[-3] != K_KEYWORD) or (self.s[-3] != 'let')) and (self.t[-2] == K_CHAR) and (self.s[-2] == '!') and (self.t[-1] == K_EXPR):
-			print "  fwm"
-			self.snarf(-2, 1)
-			return True
-
-		# number
-		elif (len(self.s) >= 1) and (self.t[-1] == K_NUMBER):
-			print "  lit " + self.s[-1]
-			self.t[-1] = K_EXPR
-			return True
-
-		# !let/\!declare word
-		elif (len(self.s) > 1) and (self.context == None) and ((self.t[-2] != K_KEYWORD) or (self.t[-2] == K_KEYWORD and self.s[-2] not in ['let', 'declare'])) and (self.t[-1] == K_WORD):
-			print "  lit "+self.s[-1]
-			print "  fwm"
-			self.t[-1] = K_EXPR
-			return True
-
-		# sub word
-		elif (len(self.s) > 1) and (self.t[-2] == K_WORD) and (self.t[-1] == K_CHAR) and (self.s[-1] == ':'):
-			l = alloclabel()
-			print "L%d:" % l
-			procs.append((self.s[-2], l))
-			self.snarf(-2,2)
-			return True
-
-		# goto expr ;
-		elif (len(self.s) > 2) and (self.t[-3] == K_KEYWORD) and (self.s[-3] == 'goto') and (self.t[-2] == K_EXPR) and (self.t[-1] == K_CHAR) and (self.s[-1] == ';'):
-			print "  go"
-			self.snarf(-3, 3)
-			return True
-
-		# ... if expr ;
-		elif (len(self.s) > 2) and (self.t[-3] == K_KEYWORD) and (self.s[-3] == 'if') and (self.t[-2] == K_EXPR) and (self.t[-1] == K_CHAR) and (self.s[-1] == ';'):
-			l1 = alloclabel()
-			print "  lit L%d\n  zgo" % l1
-			self.nextlinelabel = l1
-			self.snarf(-3, 2)
-			return True
-
-		# return ;
-		elif (len(self.s) > 1) and (self.t[-2] == K_KEYWORD) and (self.s[-2] == 'return') and (self.t[-1] == K_CHAR) and (self.s[-1] == ';'):
-			print "  rfs"
-			self.snarf(-2, 2)
-			return True
-
-		# delcare idlist , word
-		elif (len(self.s) > 3) and (self.context == 'declare') and (self.t[-2] == K_CHAR) and (self.s[-2] == ',') and (self.t[-1] == K_WORD):
-			self.vardecls.append(self.s[-1])
-			self.snarf(-2,2)
-			return True
-
-		# declare word (declare context)
-		elif (len(self.s) >= 1) and (self.context == 'declare') and (self.t[-1] == K_WORD):
-			self.vardecls = [self.s[-1]]
-			self.t[-1] = K_IDLIST
-			return True
-
-		# declare idlist ;
-		elif (len(self.s) > 2) and (self.t[-3] == K_KEYWORD) and (self.s[-3] == 'declare') and (self.t[-2] == K_IDLIST) and (self.t[-1] == K_CHAR) and (self.s[-1] == ';'):
-			self.snarf(-3, 3)
-			for v in self.vardecls:
-				print "%s:  dcw 0" % v
-			self.context = None
-			return True
-
-		# declare context
-		elif (len(self.s) > 0) and (self.t[-1] == K_KEYWORD) and (self.s[-1] == 'declare') and (self.context == None):
-			self.context = 'declare'
-
-		# let context
-		elif (len(self.s) > 0) and (self.t[-1] == K_KEYWORD) and (self.s[-1] == 'let') and (self.context == None):
-			self.context = 'let'
-
-		# call expr ;
-		elif (len(self.s) > 2) and (self.t[-3] == K_KEYWORD) and (self.s[-3] == 'call') and (self.t[-2] == K_EXPR) and (self.t[-1] == K_CHAR) and (self.s[-1] == ';'):
-			print "  call"
-			self.snarf(-3, 3)
-			return True
-
-		return False
-
-	def reduce(self):
-		reduced = True
-		while reduced:
-			reduced = self.reducestep()
-		if self.nextlinelabel:
-			print "L%d: " % self.nextlinelabel
-			self.nextlinelabel = None
+				return
+
+	def error(self, a):
+		"""
+		Reports a token the grammar doesn't allow, then skips the rest of
+		the statement.
+		"""
+		self.emit("SYNTAX ERROR: unexpected %s" % a)
+		del self.states[2:]
+		del self.values[1:]
+		self.recovering = (a != ';')
 
 	def push(self, s, t):
-		self.s.append(s)
-		self.t.append(t)
-		self.reduce()
-
-recog = RecognizerStack()
-
-def checkkw():
-	global symbol
-	global kind
-	if symbol in keywords:
-		kind = K_KEYWORD
-
-def sym():
-	global symbol, kind
-	checkkw()
-	recog.push(symbol, kind)
-
-def isstartofword(c):
-	return (97 <= ord(c) < 97+26) or (65 <= ord(c) < 65+26) or (c == '_')
-
-def isdigit(c):
-	return 48 <= ord(c) < 58
-
-def iswordchar(c):
-	return isstartofword(c) or isdigit(c)
-
-def isspace(c):
-	return ord(c) < 33
-
-def sym0():
-	if kind:
-		sym()
-
-def chr(c):
-	global symbol
-	global kind
-	if (kind != K_WORD) and isstartofword(c):
-		sym0()
-		kind = K_WORD
-		symbol = c
-	elif (kind == K_WORD) and iswordchar(c):
-		symbol = symbol + c
-	elif (kind != K_NUMBER) and isdigit(c):
-		sym0()
-		kind = K_NUMBER
-		symbol = c
-	elif (kind == K_NUMBER) and isdigit(c):
-		symbol = symbol + c
-	elif (kind != K_SPACE) and isspace(c):
-		sym0()
-		kind = K_SPACE
-		symbol = ''
-	elif (kind == K_SPACE) and isspace(c):
-		pass # we ignore spaces.
-	else:
-		sym0()
-		kind = K_CHAR
-		symbol = c
-
-def dumpprocvars():
-	for pv in procs:
-		print "%s: dcw L%d" % (pv[0], pv[1])
+		a = terminal(s, t)
+		if self.recovering:
+			self.recovering = (a != ';')
+		else:
+			self.parse(a, s)
+
+	def end(self):
+		self.parse(lalr.END, None)
+
+	def on_label(self, word, colon):
+		self.statement(Statement('label', name=word))
+
+	def on_declare(self, declare, idlist, semicolon):
+		self.statement(Statement('declare', names=idlist))
+
+	def on_let(self, let, word, equals, expr, tail):
+		self.statement(Statement('let', name=word, value=expr, conditions=tail))
+
+	def on_store(self, let, bang, primary, equals, expr, tail):
+		self.statement(Statement('store', address=primary, value=expr, conditions=tail))
+
+	def on_goto(self, goto, expr, tail):
+		self.statement(Statement('goto', value=expr, conditions=tail))
+
+	def on_call(self, call, expr, tail):
+		self.statement(Statement('call', value=expr, conditions=tail))
+
+	def on_ret(self, ret, tail):
+		self.statement(Statement('ret', conditions=tail))
+
+	def on_endtail(self, semicolon):
+		return []
+
+	def on_conditional(self, i, expr, tail):
+		return [expr] + tail
+
+	def on_idlist(self, word):
+		return [word]
+
+	def on_idlist_more(self, idlist, comma, word):
+		return idlist + [word]
+
+	def on_binary(self, a, op, b):
+		return (op, a, b)
+
+	def on_parens(self, lparen, expr, rparen):
+		return expr
+
+	def on_number(self, n):
+		return ('number', n)
+
+	def on_variable(self, word):
+		return ('variable', word)
+
+	def on_fetch(self, bang, primary):
+		return ('fetch', primary)
+
+class Statement(object):
+	"""
+	One statement of the intermediate representation.  kind is the name of
+	the grammar rule it comes from: label (with the label's name), declare
+	(names), let (name and value), store (address and value), goto and
+	call (value), or ret.  It only executes if all its conditions, listed
+	outermost first, are true.
+
+	Expressions are tuples: ('number', text), ('variable', name),
+	('fetch', address), or (operator, left, right) with one of the binary
+	operators + & ~ ^ ! - = #.
+	"""
+	def __init__(self, kind, name=None, names=None, address=None, value=None, conditions=()):
+		self.kind = kind
+		self.name = name
+		self.names = names
+		self.address = address
+		self.value = value
+		self.conditions = conditions
+
+# S16X4 instructions for the binary operators other than = and #.
+s16x4ops = {
+	'+': ['add'],
+	'&': ['and'],
+	'~': ['cpl'],
+	'^': ['xor'],
+	'!': ['add', 'fwm'],
+	'-': ['neg'],
+}
+
+def directlabels(program):
+	"""
+	The labels a program names only as the whole target of a goto or call.
+	They can be jumped to and called directly; every other label needs a
+	variable holding its address.
+	"""
+	labels = set([s.name for s in program if s.kind == 'label'])
+	values = set()
+
+	def uses(e):
+		if e[0] == 'variable':
+			values.add(e[1])
+		elif e[0] != 'number':
+			for operand in e[1:]:
+				uses(operand)
+
+	for s in program:
+		if s.kind == 'let':
+			values.add(s.name)
+		elif s.kind == 'declare':
+			values.update(s.names)
+		if s.address is not None:
+			uses(s.address)
+		if s.value is not None and not (s.kind in ('goto', 'call') and s.value[0] == 'variable'):
+			uses(s.value)
+		for e in s.conditions:
+			uses(e)
+	return labels - values
+
+def isdirect(s, direct):
+	"""True if s is a goto or call straight to one of the direct labels."""
+	return s.kind in ('goto', 'call') and s.value[0] == 'variable' and s.value[1] in direct
+
+class S16X4(object):
+	"""
+	Generates an S16X4 assembly listing.  Labels that goto and call only
+	ever name directly are jumped to by address; any other label also gets
+	a variable holding its address, which goto and call go through like any
+	other value.
+	"""
+	def __init__(self, out):
+		self.out = out
+		self.nextlabel = 0
+		self.procs = []
+		self.direct = set()
+		# Numbers of direct labels referred to before they're defined.
+		self.forward = {}
+		self.defined = {}
+
+	def generate(self, program, direct):
+		self.direct = direct
+		for s in program:
+			self.statement(s)
+		self.finish()
+
+	def emit(self, line):
+		self.out.write(line + "\n")
+
+	def alloclabel(self):
+		l = self.nextlabel
+		self.nextlabel = self.nextlabel+1
+		return l
+
+	def statement(self, s):
+		if s.kind == 'goto' and len(s.conditions) == 1 and s.conditions[0][0] == '=':
+			# zgo is a goto if equal all by itself.
+			self.difference(s.conditions[0])
+			self.target(s)
+			self.emit("  zgo")
+			return
+		if s.address is not None:
+			self.expr(s.address)
+		self.target(s)
+		for e in s.conditions:
+			self.condition(e)
+		# Any condition that fails skips the statement.
+		l = None
+		if s.conditions:
+			l = self.alloclabel()
+		for e in reversed(s.conditions):
+			if e[0] == '=':
+				run = self.alloclabel()
+				self.emit("  lit L%d\n  zgo\n  lit L%d\n  go\nL%d:" % (run, l, run))
+			else:
+				self.emit("  lit L%d\n  zgo" % l)
+		getattr(self, s.kind)(s)
+		if l is not None:
+			self.emit("L%d: " % l)
+
+	def target(self, s):
+		if isdirect(s, self.direct):
+			self.emit("  lit L%d" % self.labelnumber(s.value[1]))
+		elif s.value is not None:
+			self.expr(s.value)
+
+	def condition(self, e):
+		"""
+		Pushes something zero when the condition is false, except for =,
+		whose operands' difference is zero when it's true.  Either way, a
+		comparison costs no more than the xor.
+		"""
+		if e[0] in ('=', '#'):
+			self.difference(e)
+		else:
+			self.expr(e)
+
+	def difference(self, e):
+		"""Pushes something that's zero just when e's operands are equal."""
+		self.expr(e[1])
+		if e[2][0] != 'number' or int(e[2][1]) != 0:
+			self.expr(e[2])
+			self.emit("  xor")
+
+	def labelnumber(self, name):
+		if name in self.defined:
+			return self.defined[name]
+		if name not in self.forward:
+			self.forward[name] = self.alloclabel()
+		return self.forward[name]
+
+	def label(self, s):
+		if s.name in self.forward:
+			l = self.forward.pop(s.name)
+		else:
+			l = self.alloclabel()
+		self.defined[s.name] = l
+		if s.name in self.direct:
+			# Nothing holds a direct label's address, but keep its name
+			# in the listing.
+			self.emit("%s:" % s.name)
+		else:
+			self.procs.append((s.name, l))
+		self.emit("L%d:" % l)
+
+	def declare(self, s):
+		for v in s.names:
+			self.emit("%s:  dcw 0" % v)
+
+	def let(self, s):
+		self.emit("  lit " + s.name)
+		self.emit("  swm")
+
+	def store(self, s):
+		self.emit("  swap")
+		self.emit("  swm")
+
+	def goto(self, s):
+		self.emit("  go")
+
+	def call(self, s):
+		self.emit("  call")
+
+	def ret(self, s):
+		self.emit("  rfs")
+
+	def expr(self, e):
+		op = e[0]
+		if op == 'number':
+			self.emit("  lit " + e[1])
+		elif op == 'variable':
+			self.emit("  lit "+e[1])
+			self.emit("  fwm")
+		elif op == 'fetch':
+			self.expr(e[1])
+			self.emit("  fwm")
+		elif op == '=':
+			self.comparison(e, "$FFFF")
+		elif op == '#':
+			self.comparison(e, "0")
+		else:
+			self.expr(e[1])
+			self.expr(e[2])
+			for i in s16x4ops[op]:
+				self.emit("  " + i)
+
+	def comparison(self, e, equal):
+		# Flipping every bit of the equal flag makes the unequal one, so
+		# only equal operands need a branch, around the flip.
+		self.emit("  lit " + equal)
+		self.difference(e)
+		l = self.alloclabel()
+		self.emit("  lit L%d\n  zgo" % l)
+		self.emit("  lit $FFFF\n  xor")
+		self.emit("L%d:" % l)
+
+	def finish(self):
+		for pv in self.procs:
+			self.emit("%s: dcw L%d" % (pv[0], pv[1]))
+
+# Code generators, by name.
+targets = {
+	's16x4': S16X4,
+	'riscv': stplrv.RiscV,
+}
+
+# Source is read this many characters at a time.
+BLOCKSIZE = 65536
+
+class Compiler(object):
+	"""
+	Compiles one STPL program, fed to it a piece at a time with feed() or a
+	file at a time with compilefile().  finish() ends the program and
+	writes its listing for target (one of targets) to out.  Code can only
+	be generated once the whole program is known, since whether a label
+	needs a variable depends on every use of it.  The recognizer's states
+	go to out as it goes, if trace is set.  Each Compiler has its own
+	state, so any number of them can run at once.
+	"""
+	def __init__(self, out, trace=False, target='s16x4'):
+		self.out = out
+		self.pending = ''
+		self.backend = targets[target](out)
+		self.program = []
+		self.recog = RecognizerStack(self, trace)
+
+	def emit(self, line):
+		self.out.write(line + "\n")
+
+	def statement(self, s):
+		self.program.append(s)
+
+	def feed(self, text, last=False):
+		"""
+		Lexes more of the program.  A word, number or run of spaces at the
+		end of text might go on in the text that follows, so it's held back
+		until then, unless this is the last of it.
+		"""
+		text = self.pending + text
+		self.pending = ''
+		tokens = tokenpattern.findall(text)
+		if not last and len(tokens) > 0 and not tokens[-1][3]:
+			self.pending = ''.join(tokens.pop())
+		push = self.recog.push
+		for word, number, space, char in tokens:
+			if word:
+				if word in keywords:
+					push(word, K_KEYWORD)
+				else:
+					push(word, K_WORD)
+			elif number:
+				push(number, K_NUMBER)
+			elif char:
+				push(char, K_CHAR)
+
+	def compilefile(self, f):
+		while True:
+			block = f.read(BLOCKSIZE)
+			if not block:
+				break
+			self.feed(block)
+		# A token can't run on from one file into the next.
+		self.feed('', True)
+
+	def finish(self):
+		self.feed('', True)
+		self.recog.end()
+		self.backend.generate(self.program, directlabels(self.program))
+		self.out.flush()
+
+def compilestring(text, trace=False, target='s16x4'):
+	"""Compiles the program in text, returning its listing."""
+	f = StringIO()
+	c = Compiler(Sink(f), trace, target)
+	c.compilefile(StringIO(text))
+	c.finish()
+	return f.getvalue()
+
+try:
+	stringtypes = (str, unicode)
+except NameError:
+	stringtypes = (str,)
+
+# What each field of a compile request has to be, and its type(s).
+requestfields = [
+	('source', 'a string', stringtypes),
+	('output', 'a string', stringtypes),
+	('target', 'a string', stringtypes),
+	('trace', 'true or false', bool),
+	('files', 'a list of strings', list),
+]
 
-def main():
-	global symbol
-	symbol = ""
-	for ch in src:
-		chr(ch)
-	dumpprocvars()
+def badrequest(request):
+	"""What's wrong with the compile request, or None if nothing is."""
+	if not isinstance(request, dict):
+		return 'request is not an object'
+	for key, what, types in requestfields:
+		if key in request and not isinstance(request[key], types):
+			return '%s must be %s' % (key, what)
+	for name in request.get('files', []):
+		if not isinstance(name, stringtypes):
+			return 'files must be a list of strings'
+	return None
+
+def compilerequest(request):
+	"""
+	Carries out a compile request: a dict with the program's "source" text
+	or a list of its source "files", or both (the source comes first), and
+	optionally an "output" file for the listing, "trace": true to trace the
+	recognizer in it, a "target" other than s16x4, and an "id" to copy into
+	the response.  The response is a dict with the "listing", unless it
+	went to the output file, or else an "error".
+	"""
+	response = {}
+	if isinstance(request, dict) and 'id' in request:
+		response['id'] = request['id']
+	error = badrequest(request)
+	if error is not None:
+		response['error'] = 'bad request: %s' % error
+		return response
+	target = request.get('target', 's16x4')
+	if target not in targets:
+		response['error'] = 'no target %s' % target
+		return response
+	try:
+		if 'output' in request:
+			f = open(request['output'], 'w')
+		else:
+			f = StringIO()
+		try:
+			c = Compiler(Sink(f), request.get('trace', False), target)
+			if 'source' in request:
+				source = request['source']
+				if not isinstance(source, str):
+					# Python 2's json gives unicode; read it as bytes, like a file.
+					source = source.encode('utf-8')
+				c.compilefile(StringIO(source))
+			for name in request.get('files', []):
+				with open(name) as g:
+					c.compilefile(g)
+			c.finish()
+			if 'output' not in request:
+				response['listing'] = f.getvalue()
+		finally:
+			f.close()
+	except Exception as e:
+		response['error'] = str(e)
+	return response
+
+def ignoreinterrupts():
+	# ^C stops the server, which then stops its workers.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def stopserving(signum, frame):
+	# SIGTERM stops the server the way ^C does, so it still cleans up
+	# after itself, removing its socket.
+	raise KeyboardInterrupt
+
+def serveline(line):
+	"""Answers one line of JSON with another."""
+	try:
+		request = json.loads(line)
+	except ValueError as e:
+		return json.dumps({'error': 'bad request: %s' % e})
+	return json.dumps(compilerequest(request))
+
+def serve(pool, inp, outp):
+	"""
+	Answers the requests read from inp, in the order they came, while the
+	pool works on the ones behind them.
+	"""
+	lines = (l for l in iter(inp.readline, '') if l.strip())
+	for response in pool.imap(serveline, lines):
+		outp.write(response + "\n")
+		outp.flush()
+
+def servesocket(pool, path):
+	"""
+	Answers requests on a Unix socket at path, any number of connections
+	at once, until interrupted.
+	"""
+	class Handler(socketserver.StreamRequestHandler):
+		def handle(self):
+			for line in iter(self.rfile.readline, b''):
+				if line.strip():
+					response = pool.apply(serveline, (line.decode('utf-8'),))
+					self.wfile.write((response + "\n").encode('utf-8'))
+
+	server = socketserver.ThreadingUnixStreamServer(path, Handler)
+	server.daemon_threads = True
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		os.unlink(path)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Compile STPL to S16X4 or RISC-V assembly.")
+	parser.add_argument("files", nargs="*", help="source files, - for standard input")
+	parser.add_argument("-o", "--output", help="write the listing here instead of to standard output")
+	parser.add_argument("-t", "--target", choices=sorted(targets), default="s16x4",
+			help="the instruction set to compile for (default s16x4)")
+	parser.add_argument("--trace", action="store_true",
+			help="show the recognizer's stack before every step")
+	parser.add_argument("--serve", action="store_true",
+			help="answer JSON compile requests on standard input and output")
+	parser.add_argument("--socket", metavar="PATH",
+			help="answer JSON compile requests on a Unix socket")
+	parser.add_argument("-j", "--jobs", type=int, default=0,
+			help="server worker processes (default 0: one per CPU)")
+	args = parser.parse_args(argv)
+
+	if args.serve or args.socket:
+		pool = multiprocessing.Pool(args.jobs or None, ignoreinterrupts)
+		signal.signal(signal.SIGTERM, stopserving)
+		try:
+			if args.socket:
+				servesocket(pool, args.socket)
+			else:
+				serve(pool, sys.stdin, sys.stdout)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			pool.terminate()
+			pool.join()
+		return 0
+
+	if args.output:
+		out = Sink(open(args.output, "w"))
+	else:
+		out = Sink(sys.stdout)
+	c = Compiler(out, args.trace, args.target)
+	try:
+		if len(args.files) == 0:
+			c.feed(src)
+		for name in args.files:
+			if name == "-":
+				c.compilefile(sys.stdin)
+			else:
+				with open(name) as f:
+					c.compilefile(f)
+		c.finish()
+	except Exception as e:
+		sys.stderr.write("%s: %s\n" % (parser.prog, e))
+		return 1
+	finally:
+		out.flush()
+		if args.output:
+			out.f.close()
+	return 0
 
 if __name__=='__main__':
-	main()
-
+	sys.exit(main())
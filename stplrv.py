@@ -0,0 +1,179 @@
+"""
+RISC-V code generation for STPL, through the peephole code generator.
+
+Expressions are compiled with the Optimizer's stack primitives, so their
+values live in registers rather than on a stack in memory.  STPL words are
+the target's 64-bit words, and comparisons yield -1 for true.  The
+operators mean what the S16X4 listing's instructions do: - subtracts, !
+adds and fetches, and ~ clears the bits of its right operand in its left.
+
+Declared variables live in the literal pool.  goto and call go straight to
+labels they name directly, if that's all the program does with them.  Any
+other label gets a variable in the pool too, holding its address, for
+goto, call and let to use like any other value.  The subroutine named INIT
+fills those in, so it has to run before the program does.  call keeps RA
+on the return stack in memory, so the caller has to point RSP, as well as
+DSP, at some.
+"""
+
+import peephole
+
+
+INIT = "stpl_init"
+
+
+def index(o):
+    o.add(); o.optimize()
+    o.fetch()
+
+
+def clear_bits(o):
+    o.xor_imm(-1); o.optimize()
+    o.And()
+
+
+def equal(o):
+    o.xor(); o.optimize()
+    o.zero_equal()
+
+
+def unequal(o):
+    o.xor(); o.optimize()
+    o.zero_unequal()
+
+
+BINARY = {
+    "+": peephole.Optimizer.add,
+    "&": peephole.Optimizer.And,
+    "~": clear_bits,
+    "^": peephole.Optimizer.xor,
+    "!": index,
+    "-": peephole.Optimizer.sub,
+    "=": equal,
+    "#": unequal,
+}
+
+# A comparison that's a condition branches on its operands directly.
+CONDITIONS = {
+    "=": peephole.Optimizer.if_equal,
+    "#": peephole.Optimizer.if_unequal,
+}
+
+
+class RiscV(object):
+    """
+    Compiles STPL statements into an Optimizer, and writes the finished
+    program's listing to out.
+    """
+
+    def __init__(self, out, **options):
+        self.out = out
+        self.o = peephole.Optimizer(trace=False, **options)
+        self.slots = {}
+        self.declared = set()
+        self.labels = []
+        self.direct = set()
+
+    def generate(self, program, direct):
+        self.direct = direct
+        for s in program:
+            self.statement(s)
+        self.finish()
+
+    def slot(self, name):
+        if name not in self.slots:
+            self.slots[name] = self.o.variable()
+        return self.slots[name]
+
+    def statement(self, s):
+        for e in s.conditions:
+            if e[0] in CONDITIONS:
+                self.expr(e[1])
+                self.expr(e[2])
+                CONDITIONS[e[0]](self.o)
+            else:
+                self.expr(e)
+                self.o.If()
+            self.o.optimize()
+        getattr(self, s.kind)(s)
+        self.o.optimize()
+        for e in s.conditions:
+            self.o.Then(); self.o.optimize()
+
+    def label(self, s):
+        if s.name == INIT:
+            raise Exception("{} is reserved".format(INIT))
+        self.o.subroutine(s.name)
+        if s.name not in self.direct:
+            self.labels.append(s.name)
+        self.declared.add(s.name)
+
+    def declare(self, s):
+        for v in s.names:
+            self.slot(v)
+            self.declared.add(v)
+
+    def let(self, s):
+        self.expr(s.value)
+        self.o.store_variable(self.slot(s.name))
+
+    def store(self, s):
+        self.expr(s.address)
+        self.expr(s.value)
+        self.o.swap(); self.o.optimize()
+        self.o.store()
+
+    def is_direct(self, s):
+        return s.value[0] == "variable" and s.value[1] in self.direct
+
+    def goto(self, s):
+        if self.is_direct(s):
+            self.o.jump(s.value[1])
+        else:
+            self.expr(s.value)
+            self.o.go()
+
+    def call(self, s):
+        self.o.save_link(); self.o.optimize()
+        if self.is_direct(s):
+            self.o.call(s.value[1])
+        else:
+            self.expr(s.value)
+            self.o.call_address()
+        self.o.optimize()
+        self.o.restore_link()
+
+    def ret(self, s):
+        self.o.rfs()
+
+    def expr(self, e):
+        op = e[0]
+        if op in ("number", "variable") and len(self.o.regs_avail) == 0:
+            # The Optimizer doesn't spill the stack cache itself, so make
+            # room for the new item by writing the rest out to the stack.
+            self.o.commit(); self.o.optimize()
+        if op == "number":
+            self.o.literal(int(e[1]))
+        elif op == "variable":
+            self.o.fetch_variable(self.slot(e[1]))
+        elif op == "fetch":
+            self.expr(e[1])
+            self.o.fetch()
+        else:
+            self.expr(e[1])
+            self.expr(e[2])
+            BINARY[op](self.o)
+        self.o.optimize()
+
+    def finish(self):
+        undeclared = sorted([v for v in self.slots if v not in self.declared])
+        if len(undeclared) > 0:
+            raise Exception("Undeclared: {}".format(", ".join(undeclared)))
+
+        self.o.subroutine(INIT)
+        for name in self.labels:
+            self.o.address(name); self.o.optimize()
+            self.o.store_variable(self.slot(name)); self.o.optimize()
+        self.o.rfs()
+        peephole.finish(self.o)
+        self.out.write(self.o.listing())
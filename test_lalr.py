@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import lalr
+
+
+# Sums and products of numbers, with the usual precedence.
+ARITHMETIC = [
+    ('sum', 'sum + product', 'add'),
+    ('sum', 'product', None),
+    ('product', 'product * factor', 'mul'),
+    ('product', 'factor', None),
+    ('factor', 'n', None),
+    ('factor', '( sum )', 'parens'),
+]
+
+
+def evaluate(tables, tokens):
+    """Parses and evaluates tokens, each a number or an operator."""
+    states = [0]
+    values = []
+    tokens = list(tokens) + [lalr.END]
+    while True:
+        t = tokens[0]
+        a = tables.action[states[-1]].get('n' if isinstance(t, int) else t)
+        if a is None:
+            raise Exception("Syntax error at {}".format(t))
+        if a[0] == 's':
+            states.append(a[1])
+            values.append(t)
+            tokens.pop(0)
+        elif a[0] == 'r':
+            lhs, rhs, action = tables.productions[a[1]]
+            args = values[len(values)-len(rhs):]
+            del states[len(states)-len(rhs):]
+            del values[len(values)-len(rhs):]
+            if action == 'add':
+                v = args[0] + args[2]
+            elif action == 'mul':
+                v = args[0] * args[2]
+            elif action == 'parens':
+                v = args[1]
+            else:
+                v = args[0]
+            states.append(tables.goto[states[-1]][lhs])
+            values.append(v)
+        else:
+            return values[-1]
+
+
+class TestLALR(unittest.TestCase):
+    def testArithmetic(self):
+        tables = lalr.build(lalr.Grammar(ARITHMETIC))
+        self.assertEqual(evaluate(tables, [2, '+', 3, '*', 4]), 14)
+        self.assertEqual(evaluate(tables, ['(', 2, '+', 3, ')', '*', 4]), 20)
+        self.assertRaises(Exception, evaluate, tables, [2, '+', '*'])
+
+    def testNotSLR(self):
+        # The classic grammar that's LALR(1) but not SLR(1).
+        g = lalr.Grammar([
+            ('s', 'l = r', None),
+            ('s', 'r', None),
+            ('l', '* r', None),
+            ('l', 'id', None),
+            ('r', 'l', None),
+        ])
+        lalr.build(g)
+
+    def testConflict(self):
+        g = lalr.Grammar([
+            ('e', 'e + e', None),
+            ('e', 'n', None),
+        ])
+        self.assertRaises(Exception, lalr.build, g)
+
+    def testDefaultReductions(self):
+        tables = lalr.build(lalr.Grammar(ARITHMETIC))
+        state = tables.action[0]['n'][1]
+        self.assertEqual(tables.productions[tables.default[state]], ('factor', ('n',), None))
+
+    def testSymbols(self):
+        tables = lalr.build(lalr.Grammar(ARITHMETIC))
+        self.assertEqual(tables.symbol[0], None)
+        for row in tables.action:
+            for t, a in row.items():
+                if a[0] == 's':
+                    self.assertEqual(tables.symbol[a[1]], t)
+        for row in tables.goto:
+            for x, state in row.items():
+                self.assertEqual(tables.symbol[state], x)
+
+    def testCache(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'tables')
+            t1 = lalr.load(ARITHMETIC, path)
+            self.assertTrue(os.path.exists(path))
+            t2 = lalr.load(ARITHMETIC, path)
+            self.assertEqual(t1.to_json(), t2.to_json())
+            self.assertEqual(evaluate(t2, [2, '*', 3]), 6)
+
+            changed = ARITHMETIC + [('factor', '- factor', None)]
+            t3 = lalr.load(changed, path)
+            self.assertTrue('-' in t3.action[0])
+            self.assertNotEqual(t3.to_json(), t1.to_json())
+        finally:
+            shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,884 @@
+#!/usr/bin/env python
+
+import json
+import random
+import struct
+import time
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import cfg
+import peephole
+import rvsim
+from peephole import (OP_AUIPC, OP_BEQ, OP_BNE, OP_JAL, OP_JALR, OP_LB, OP_LD,
+                      OP_LUI, OP_SB, OP_SD)
+
+
+Optimizer = peephole.Optimizer
+
+
+# Where the tests keep the data stack, the return stack, and the words
+# fetch and store work on.
+STACK = 0x800000
+RSTACK = 0x900000
+DATA = 0x200000
+DATA_SIZE = 256
+
+# Items on the data stack when a test program starts: one in DC, the rest
+# in memory from STACK up to STACK_BOTTOM.
+INITIAL_DEPTH = 17
+STACK_BOTTOM = STACK + 8 * (INITIAL_DEPTH - 1)
+MAX_DEPTH = INITIAL_DEPTH + 4
+
+BINARY = ["add", "sub", "xor", "And", "Or", "mul", "lshift", "rshift", "arshift"]
+
+
+class Generator(object):
+    """
+    Makes random, well-formed programs: lists of (primitive, arguments)
+    pairs that never underflow the data stack, keep the return stack
+    balanced, and leave the data stack as deep after an If as before it.
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def program(self, length):
+        self.ops = []
+        self.depth = INITIAL_DEPTH
+        self.block(length, 0)
+        return self.ops
+
+    def emit(self, name, *args):
+        self.ops.append((name, args))
+
+    def number(self):
+        r = self.rng
+        return r.choice([
+            lambda: r.randint(-2048, 2047),
+            lambda: r.randint(-(1 << 31), (1 << 31) - 1),
+            lambda: r.randint(-(1 << 63), (1 << 63) - 1),
+            lambda: r.choice([0, 1, -1, 8, 63, 64, 256, 0x800, 0x7FFFF800]),
+        ])()
+
+    def literal(self, n):
+        self.emit("literal", n)
+        self.depth = self.depth + 1
+
+    def block(self, length, nesting):
+        r = self.rng
+        start = self.depth
+        pushed = 0
+        for _ in range(length):
+            room = self.depth < MAX_DEPTH
+            choice = r.randint(0, 13)
+            if choice == 0 and room:
+                self.literal(self.number())
+            elif choice == 1 and self.depth >= 3:
+                self.emit(r.choice(BINARY))
+                self.depth = self.depth - 1
+            elif choice == 2 and self.depth >= 3 and room:
+                self.literal(r.randint(0, 70))
+                self.emit(r.choice(["lshift", "rshift", "arshift"]))
+                self.depth = self.depth - 1
+            elif choice == 3 and room:
+                self.emit("dup")
+                self.depth = self.depth + 1
+            elif choice == 4:
+                self.emit("swap")
+            elif choice == 5 and room:
+                self.emit("over")
+                self.depth = self.depth + 1
+            elif choice == 6 and self.depth >= 3:
+                self.emit(r.choice(["drop", "nip"]))
+                self.depth = self.depth - 1
+            elif choice == 7 and room:
+                self.literal(DATA + 8 * r.randint(0, DATA_SIZE // 8 - 1))
+                self.emit("fetch")
+            elif choice == 8 and self.depth >= 3:
+                self.literal(DATA + 8 * r.randint(0, DATA_SIZE // 8 - 1))
+                self.emit("store")
+                self.depth = self.depth - 2
+            elif choice == 9 and room:
+                self.literal(DATA + r.randint(0, DATA_SIZE - 1))
+                self.emit("cfetch")
+            elif choice == 10 and self.depth >= 3:
+                self.literal(DATA + r.randint(0, DATA_SIZE - 1))
+                self.emit("cstore")
+                self.depth = self.depth - 2
+            elif choice == 11 and self.depth >= 3 and pushed < 2:
+                self.emit("push")
+                self.depth = self.depth - 1
+                pushed = pushed + 1
+            elif choice == 12 and pushed > 0 and room:
+                self.emit("pop")
+                self.depth = self.depth + 1
+                pushed = pushed - 1
+            elif choice == 13 and nesting < 2 and self.depth >= 3 and room:
+                self.conditional(nesting)
+            else:
+                self.emit(r.choice(["add_imm", "xor_imm", "and_imm", "or_imm", "mul_imm"]),
+                          r.choice([0, 1, 3, 10, -5, 2047, -2048, 4096, 100000]))
+
+        while pushed > 0:
+            self.emit("pop")
+            self.depth = self.depth + 1
+            pushed = pushed - 1
+
+        while self.depth > start and self.depth > 2:
+            self.emit("drop")
+            self.depth = self.depth - 1
+        while self.depth < start:
+            self.literal(self.number())
+
+    def conditional(self, nesting):
+        r = self.rng
+        flag = r.randint(0, 2)
+        if flag == 0:
+            self.literal(r.choice([0, 1]))
+        elif flag == 1:
+            self.emit("dup")
+            self.depth = self.depth + 1
+            self.literal(r.choice([0, 8, -1]))
+            self.emit("xor")
+            self.depth = self.depth - 1
+        self.emit("If")
+        self.depth = self.depth - 1
+        self.block(r.randint(0, 8), nesting + 1)
+        if r.randint(0, 3) == 0:
+            self.emit("rfs")
+        self.emit("Then")
+
+
+class Model(object):
+    """
+    What a Generator program means, worked out directly in Python rather
+    than through the Optimizer, so bugs in code both compiled versions
+    share can't go unnoticed.  run() returns what execute() does.
+    """
+
+    BINARY = {
+        "add": lambda a, b: a + b,
+        "sub": lambda a, b: a - b,
+        "xor": lambda a, b: a ^ b,
+        "And": lambda a, b: a & b,
+        "Or": lambda a, b: a | b,
+        "mul": lambda a, b: a * b,
+        "lshift": lambda a, b: a << (b & 63),
+        "rshift": lambda a, b: (a & peephole.MASK64) >> (b & 63),
+        "arshift": lambda a, b: a >> (b & 63),
+    }
+
+    IMMEDIATE = {
+        "add_imm": "add",
+        "xor_imm": "xor",
+        "and_imm": "And",
+        "or_imm": "Or",
+        "mul_imm": "mul",
+    }
+
+    def run(self, program, initial):
+        self.stack = list(reversed(initial))
+        self.rstack = []
+        self.data = bytearray(DATA_SIZE)
+        n = 0
+        while n < len(program):
+            name, args = program[n]
+            n = n + 1
+            if name == "rfs":
+                break
+            elif name == "If":
+                if self.pop() == 0:
+                    n = self.skip(program, n)
+            elif name != "Then":
+                self.step(name, args)
+        dsp = STACK_BOTTOM - 8 * (len(self.stack) - 1)
+        return dsp, list(reversed(self.stack)), list(self.data)
+
+    def skip(self, program, n):
+        """The index just past the Then matching the If before n."""
+        depth = 1
+        while depth > 0:
+            name, args = program[n]
+            if name == "If":
+                depth = depth + 1
+            elif name == "Then":
+                depth = depth - 1
+            n = n + 1
+        return n
+
+    def push(self, n):
+        self.stack.append(rvsim.signed64(n))
+
+    def pop(self):
+        return self.stack.pop()
+
+    def load(self, addr, size):
+        return sum([self.data[addr - DATA + k] << (8 * k) for k in range(size)])
+
+    def store(self, addr, value, size):
+        for k in range(size):
+            self.data[addr - DATA + k] = (value >> (8 * k)) & 0xFF
+
+    def step(self, name, args):
+        s = self.stack
+        if name == "literal":
+            self.push(args[0])
+        elif name in self.BINARY:
+            b = self.pop()
+            self.push(self.BINARY[name](self.pop(), b))
+        elif name in self.IMMEDIATE:
+            self.push(self.BINARY[self.IMMEDIATE[name]](self.pop(), args[0]))
+        elif name == "dup":
+            self.push(s[-1])
+        elif name == "over":
+            self.push(s[-2])
+        elif name == "swap":
+            s[-1], s[-2] = s[-2], s[-1]
+        elif name == "drop":
+            self.pop()
+        elif name == "nip":
+            del s[-2]
+        elif name == "fetch":
+            self.push(rvsim.signed64(self.load(self.pop(), 8)))
+        elif name == "cfetch":
+            self.push(rvsim.signed8(self.load(self.pop(), 1)))
+        elif name == "store":
+            addr = self.pop()
+            self.store(addr, self.pop(), 8)
+        elif name == "cstore":
+            addr = self.pop()
+            self.store(addr, self.pop(), 1)
+        elif name == "push":
+            self.rstack.append(self.pop())
+        elif name == "pop":
+            self.push(self.rstack.pop())
+        else:
+            raise Exception("No model of {}".format(name))
+
+
+def compile_program(program, optimize):
+    o = Optimizer(trace=False, peephole=optimize)
+    o.subroutine("main")
+    for name, args in program:
+        getattr(o, name)(*args)
+        o.optimize()
+    o.rfs(); o.optimize()
+    if optimize:
+        o.eliminate_stack_traffic(); o.cleanup(); o.schedule()
+    o.relocate()
+    return o
+
+
+def execute(o, initial, entry="main"):
+    m = rvsim.Machine(o.I, list(o.C))
+    m.x[Optimizer.DC] = initial[0]
+    m.x[Optimizer.DSP] = STACK
+    m.x[Optimizer.RSP] = RSTACK
+    for k, n in enumerate(initial[1:]):
+        m.store(STACK + 8 * k, n, 8)
+    m.call(entry)
+
+    dsp = m.x[Optimizer.DSP]
+    stack = [m.x[Optimizer.DC]]
+    stack.extend([rvsim.signed64(m.load(a, 8)) for a in range(dsp, STACK_BOTTOM, 8)])
+    data = [m.load(a, 1) for a in range(DATA, DATA + DATA_SIZE)]
+    return dsp, stack, data
+
+
+class TestDifferential(unittest.TestCase):
+    """
+    Runs random programs compiled with and without the peephole rules and
+    later passes, and checks both leave the stack and memory Model says
+    they should.
+    """
+
+    PROGRAMS = 400
+
+    def testRandomPrograms(self):
+        skipped = 0
+        for seed in range(self.PROGRAMS):
+            rng = random.Random(seed)
+            program = Generator(rng).program(rng.randint(1, 30))
+            initial = [rng.randint(-(1 << 63), (1 << 63) - 1) for _ in range(INITIAL_DEPTH)]
+            expected = Model().run(program, initial)
+
+            for optimize in [False, True]:
+                try:
+                    o = compile_program(program, optimize)
+                except Exception as e:
+                    # The stack cache doesn't spill when it runs out of
+                    # registers; such programs can't be compiled at all.
+                    if "Out of registers" not in str(e):
+                        raise
+                    skipped = skipped + 1
+                    continue
+                self.assertEqual(
+                    execute(o, initial), expected,
+                    "seed {}, optimize {}: {}\n{}".format(seed, optimize, program, o.listing()),
+                )
+        self.assertTrue(skipped < self.PROGRAMS // 5)
+
+    def testMultiplyByLiveRegister(self):
+        # copy-into-reg-op leaves the over's source register in the mul,
+        # and it's still live, so it can't be the shift-and-add scratch.
+        initial = [11] + [0] * (INITIAL_DEPTH - 1)
+        for k in [3, 5, 6, 7, -3, 8]:
+            program = [("literal", (k,)), ("over", ()), ("mul", ())]
+            expected = Model().run(program, initial)
+            for optimize in [False, True]:
+                o = compile_program(program, optimize)
+                self.assertEqual(execute(o, initial), expected, "{}\n{}".format(k, o.listing()))
+
+    def testOptimizedIsNoLarger(self):
+        for seed in range(50):
+            rng = random.Random(seed)
+            program = Generator(rng).program(20)
+            try:
+                reference = compile_program(program, False)
+            except Exception:
+                continue
+            optimized = compile_program(program, True)
+            self.assertTrue(peephole.code_size(optimized.I) <= peephole.code_size(reference.I))
+
+
+class TestLiteralPool(unittest.TestCase):
+    def testAnchors(self):
+        # More constants than one anchor's 12-bit reach covers, some of
+        # them again at the end, and some that LUI and ADDI can build.
+        rng = random.Random(1)
+        constants = [rng.randint(1 << 40, 1 << 62) for _ in range(700)]
+        small = [0x12345678, 0x12345000, -0x7FFFF800]
+        program = []
+        for n in constants + constants[:5] + small:
+            program.extend([("literal", (n,)), ("add", ())])
+        initial = [0] * INITIAL_DEPTH
+        expected = Model().run(program, initial)
+        for optimize in [False, True]:
+            o = compile_program(program, optimize)
+            self.assertEqual(execute(o, initial), expected)
+            self.assertEqual(sorted(o.C), sorted(constants))
+            anchors = [i for i in o.I if i.op == OP_AUIPC]
+            self.assertTrue(len(anchors) >= 3)
+            self.assertEqual(len([i for i in o.I if i.op == peephole.OP_LUI]), len(small))
+
+
+class TestSimulator(unittest.TestCase):
+    def testCounters(self):
+        I = [
+            peephole.Label("main"),
+            peephole.LD(5, 0, 4),
+            peephole.ADDI(5, 5, 1),
+            peephole.SD(5, 0, 4),
+            peephole.BEQ(0, 0, peephole.Label("out")),
+            peephole.ADDI(5, 5, 1),
+            peephole.Label("out"),
+            peephole.JALR(0, 0, 1),
+        ]
+        m = rvsim.Machine(I)
+        m.x[4] = DATA
+        m.store(DATA, 41, 8)
+        m.call("main")
+        self.assertEqual(m.load(DATA, 8), 42)
+        self.assertEqual(m.counters, {
+            "instructions": 5,
+            "loads": 1,
+            "stores": 1,
+            "taken branches": 2,
+            # The ADDI waits two cycles for the load.
+            "cycles": 7,
+        })
+
+
+def sign_extend(n, bits):
+    if n & (1 << (bits - 1)):
+        return n - (1 << bits)
+    return n
+
+
+# (opcode, funct3, funct7 or None) -> mnemonic, for the forms the encoders
+# produce.  For the shifts by an immediate, funct7 is the top bits of the
+# immediate field.
+MNEMONICS = {
+    (0x33, 0, 0x00): "add", (0x33, 0, 0x20): "sub", (0x33, 0, 0x01): "mul",
+    (0x33, 1, 0x00): "sll", (0x33, 3, 0x00): "sltu", (0x33, 4, 0x00): "xor",
+    (0x33, 5, 0x00): "srl", (0x33, 5, 0x20): "sra", (0x33, 6, 0x00): "or",
+    (0x33, 7, 0x00): "and",
+    (0x13, 0, None): "addi", (0x13, 3, None): "sltiu", (0x13, 4, None): "xori",
+    (0x13, 6, None): "ori", (0x13, 7, None): "andi",
+    (0x13, 1, 0x00): "slli", (0x13, 5, 0x00): "srli", (0x13, 5, 0x20): "srai",
+    (0x03, 0, None): "lb", (0x03, 3, None): "ld",
+    (0x23, 0, None): "sb", (0x23, 3, None): "sd",
+    (0x63, 0, None): "beq", (0x63, 1, None): "bne",
+    (0x67, 0, None): "jalr", (0x6F, None, None): "jal",
+    (0x17, None, None): "auipc", (0x37, None, None): "lui",
+}
+
+
+def decode(word, pc):
+    """
+    Decodes an RV64IM word, independently of the encoders, into the
+    mnemonic and operands in the order the listing shows them, with branch
+    and jump targets as absolute addresses.
+    """
+    opcode = word & 0x7F
+    rd = (word >> 7) & 31
+    funct3 = (word >> 12) & 7
+    rs1 = (word >> 15) & 31
+    rs2 = (word >> 20) & 31
+    funct7 = word >> 25
+    i_imm = sign_extend(word >> 20, 12)
+
+    if opcode == 0x33:
+        return MNEMONICS[(opcode, funct3, funct7)], rd, rs1, rs2
+    if opcode == 0x13 and funct3 in (1, 5):
+        return MNEMONICS[(opcode, funct3, funct7 & ~1)], rd, rs1, (word >> 20) & 63
+    if opcode in (0x13, 0x03, 0x67):
+        return MNEMONICS[(opcode, funct3, None)], rd, rs1, i_imm
+    if opcode == 0x23:
+        imm = sign_extend((funct7 << 5) | rd, 12)
+        return MNEMONICS[(opcode, funct3, None)], rs2, rs1, imm
+    if opcode == 0x63:
+        imm = (((word >> 31) & 1) << 12) | (((word >> 7) & 1) << 11) | (((word >> 25) & 0x3F) << 5) | (((word >> 8) & 0xF) << 1)
+        return MNEMONICS[(opcode, funct3, None)], rs1, rs2, pc + sign_extend(imm, 13)
+    if opcode == 0x6F:
+        imm = (((word >> 31) & 1) << 20) | (((word >> 12) & 0xFF) << 12) | (((word >> 20) & 1) << 11) | (((word >> 21) & 0x3FF) << 1)
+        return "jal", rd, pc + sign_extend(imm, 21)
+    return MNEMONICS[(opcode, None, None)], rd, sign_extend(word >> 12, 20)
+
+
+def operands(i, labels):
+    """The operands decode() should find in i's encoding."""
+    if i.op in (OP_BEQ, OP_BNE):
+        return i.opc, i.src1, i.src2, labels[i.label.name]
+    if i.op == OP_JAL:
+        return i.opc, i.dest, labels[i.label.name]
+    if i.op in (OP_AUIPC, OP_LUI):
+        return i.opc, i.dest, i.imm20
+    if i.op in (OP_LD, OP_LB, OP_JALR):
+        return i.opc, i.dest, i.index, i.offset
+    if i.op in (OP_SD, OP_SB):
+        return i.opc, i.src, i.index, i.offset
+    if hasattr(i, "imm12"):
+        return i.opc, i.dest, i.src1, i.imm12
+    return i.opc, i.dest, i.src1, i.src2
+
+
+class TestEncoding(unittest.TestCase):
+    LABELS = {"back": 0x1000 - 4096, "near": 0x1000 + 8, "far": 0x1000 + (1 << 20) - 2}
+    PC = 0x1000
+
+    def roundtrip(self, i):
+        word = i.encode(self.PC, self.LABELS)
+        self.assertTrue(0 <= word < (1 << 32))
+        self.assertEqual(decode(word, self.PC), operands(i, self.LABELS), repr(i))
+        return word
+
+    def testFormats(self):
+        P = peephole
+        for cls in [P.ADD, P.SUB, P.MUL, P.SLL, P.SRL, P.SRA, P.SLTU, P.XOR, P.OR, P.AND]:
+            self.roundtrip(cls(31, 1, 17))
+            self.roundtrip(cls(5, 0, 30))
+        for cls in [P.ADDI, P.SLTIU, P.XORI, P.ORI, P.ANDI]:
+            for imm in [0, 1, -1, 2047, -2048, -8]:
+                self.roundtrip(cls(7, 12, imm))
+        for cls in [P.SLLI, P.SRLI, P.SRAI]:
+            for shamt in [0, 1, 31, 32, 63]:
+                self.roundtrip(cls(9, 3, shamt))
+        for cls in [P.LD, P.LB, P.SD, P.SB, P.JALR]:
+            for offset in [0, 8, -8, 2047, -2048]:
+                self.roundtrip(cls(5, offset, 4))
+        for cls in [P.LUI, P.AUIPC]:
+            for imm in [0, 1, -1, 0x7FFFF, -0x80000]:
+                self.roundtrip(cls(31, imm))
+        for cls in [P.BEQ, P.BNE]:
+            for name in ["back", "near"]:
+                self.roundtrip(cls(5, 6, P.Label(name)))
+        for name in ["back", "near", "far"]:
+            self.roundtrip(P.JAL(1, P.Label(name)))
+
+    def testKnownWords(self):
+        # Checked against a disassembler.
+        P = peephole
+        for i, word in [
+            (P.JALR(0, 0, 1), 0x00008067),
+            (P.ADDI(0, 0, 0), 0x00000013),
+            (P.LD(5, -8, 4), 0xFF823283),
+            (P.SD(3, -8, 4), 0xFE323C23),
+            (P.SRAI(5, 5, 63), 0x43F2D293),
+            (P.SUB(5, 0, 5), 0x405002B3),
+            (P.BNE(5, 0, P.Label("near")), 0x00029463),
+            (P.JAL(0, P.Label("back")), 0x800FF06F),
+            (P.JAL(1, P.Label("far")), 0x7FFFF0EF),
+            (P.BEQ(5, 6, P.Label("back")), 0x80628063),
+            (P.SLTU(5, 0, 6), 0x006032B3),
+            (P.SB(5, -2048, 4), 0x80520023),
+            (P.LUI(31, -1), 0xFFFFFFB7),
+        ]:
+            self.assertEqual(i.encode(self.PC, self.LABELS), word, repr(i))
+
+    def testOutOfRange(self):
+        P = peephole
+        for i in [
+            P.ADDI(5, 5, 2048), P.ADDI(5, 5, -2049), P.LD(5, 4096, 4), P.SD(5, -2049, 4),
+            P.LUI(5, 0x80000), P.AUIPC(5, -0x80001), P.SLLI(5, 5, 64), P.SRAI(5, 5, -1),
+        ]:
+            self.assertRaises(Exception, i.encode, self.PC, self.LABELS)
+        labels = {"early": self.PC - 4098, "late": self.PC + 4096, "away": self.PC + (1 << 20)}
+        for i in [P.BEQ(5, 6, P.Label("early")), P.BNE(5, 6, P.Label("late")), P.JAL(0, P.Label("away"))]:
+            try:
+                i.encode(self.PC, labels)
+            except Exception as e:
+                self.assertTrue("doesn't fit" in str(e), str(e))
+            else:
+                self.fail("{} encoded".format(i))
+        try:
+            P.JAL(0, P.Label("nowhere")).encode(self.PC, labels)
+        except Exception as e:
+            self.assertEqual(str(e), "Undefined label nowhere")
+        else:
+            self.fail("jal to an undefined label encoded")
+
+    def testAssemble(self):
+        P = peephole
+        insns = [P.Label("main"), P.LD(5, -8, 0), P.BEQ(5, 0, P.Label("out")), P.ADDI(5, 5, 1), P.Label("out"), P.JALR(0, 0, 1)]
+        image = P.assemble(insns, [-2])
+        self.assertEqual(len(image), 8 + 4 * 4)
+        self.assertEqual(image[:8], bytearray(b"\xfe" + b"\xff" * 7))
+        words = struct.unpack("<4I", bytes(image[8:]))
+        self.assertEqual(decode(words[1], 12), ("beq", 5, 0, 20))
+        self.assertEqual([decode(w, 0)[0] for w in words], ["ld", "beq", "addi", "jalr"])
+
+
+class TestMoveRegisters(unittest.TestCase):
+    def move(self, moves, avail):
+        o = Optimizer(trace=False)
+        o.regs_avail = avail
+        o.I = [peephole.Label("main")]
+        o.move_registers(moves)
+        o.I.append(peephole.JALR(0, 0, Optimizer.RA))
+        m = rvsim.Machine(o.I)
+        for r in range(5, 13):
+            m.x[r] = 100 + r
+        m.call("main")
+        for d, s in moves:
+            self.assertEqual(m.x[d], 100 + s, "{} with {} free".format(moves, avail))
+
+    def testCycles(self):
+        for moves in [
+            [(5, 6), (6, 5)],
+            [(5, 6), (6, 7), (7, 5)],
+            [(5, 6), (6, 5), (7, 5)],
+            [(5, 6), (6, 7), (7, 5), (8, 9), (9, 8)],
+            # 12 is free to start with, but not once it's been moved into.
+            [(12, 9), (6, 7), (7, 6)],
+        ]:
+            # Through a free register, and by exchanging in place.
+            self.move(moves, [12])
+            self.move(moves, [])
+
+
+class TestStackTraffic(unittest.TestCase):
+    def testMovedStackPointer(self):
+        P = peephole
+        o = Optimizer(trace=False)
+        o.I = [
+            P.Label("main"),
+            P.ORI(5, 0, 1), P.ORI(6, 0, 2), P.ORI(7, 0, 3),
+            P.SD(5, 0, Optimizer.DSP), P.SD(6, 8, Optimizer.DSP), P.SD(7, 16, Optimizer.DSP),
+            P.ADDI(Optimizer.DSP, Optimizer.DSP, -8),
+            P.LD(8, 8, Optimizer.DSP), P.LD(9, 16, Optimizer.DSP), P.LD(10, 24, Optimizer.DSP),
+            P.JALR(0, 0, Optimizer.RA),
+        ]
+        report = o.eliminate_stack_traffic()
+        self.assertEqual(report["main"], {"loads": 3, "stores": 0})
+        m = rvsim.Machine(o.I)
+        m.x[Optimizer.DSP] = STACK
+        m.call("main")
+        self.assertEqual(m.x[8:11], [1, 2, 3])
+
+
+class TestFlowGraph(unittest.TestCase):
+    def testEdges(self):
+        P = peephole
+        a = P.Label(".a", local=True)
+        b = P.Label(".b", local=True)
+        g = cfg.build([
+            P.Label("main"), P.BEQ(5, 0, a),
+            P.JAL(Optimizer.RA, P.Label("sub")),
+            P.ADDI(5, 5, 1), P.JAL(0, b),
+            a, P.ADDI(5, 5, 2),
+            b, P.JALR(0, 0, Optimizer.RA),
+            P.Label("sub"), P.JALR(0, 0, Optimizer.RA),
+        ])
+        blocks = g.blocks
+        self.assertEqual([[s.index for s in x.succs] for x in blocks], [[3, 1], [2], [4], [4], [], []])
+        self.assertEqual([[p.index for p in x.preds] for x in blocks], [[], [0], [1], [0], [2, 3], []])
+        # Calls return to the next block; jumps and returns don't.
+        self.assertEqual([x.falls_through() for x in blocks], [True, True, False, True, False, False])
+        self.assertEqual([x.single_predecessor() for x in blocks],
+                         [None, blocks[0], blocks[1], blocks[0], None, None])
+        self.assertTrue(g.block_for(a) is blocks[3])
+        self.assertTrue(g.block_for(P.Label("sub")) is blocks[5])
+        self.assertEqual(g.flatten()[:2], [blocks[0].labels[0], blocks[0].insns[0]])
+
+
+class TestSchedule(unittest.TestCase):
+    def check(self, block, order, before, after):
+        scheduled, b, a = peephole.schedule_block(block, peephole.LATENCY)
+        self.assertEqual(scheduled, [block[k] for k in order])
+        self.assertEqual((b, a), (before, after))
+
+    def testDependences(self):
+        P = peephole
+        # Independent work fills the load's shadow.
+        self.check([P.LD(5, 0, 4), P.ADDI(6, 5, 1), P.ADDI(7, 0, 2), P.ADDI(8, 0, 3), P.SD(6, 0, 4)],
+                   [0, 2, 3, 1, 4], 2, 0)
+        # A load can't overtake an earlier read of the register it writes.
+        self.check([P.ADDI(6, 5, 1), P.ADDI(9, 9, 1), P.LD(5, 0, 4), P.ADDI(7, 5, 0)],
+                   [0, 2, 1, 3], 2, 1)
+        # Loads stay after the store before them, stores after the loads.
+        self.check([P.SD(6, 0, 4), P.ADDI(9, 9, 1), P.LD(5, 8, 4), P.ADDI(7, 5, 0),
+                    P.LD(8, 16, 4), P.SD(9, 24, 4), P.ADDI(10, 8, 0)],
+                   [0, 2, 4, 1, 3, 5, 6], 3, 0)
+        # AUIPC doesn't move, and the branch ending the block stays last.
+        self.check([P.LD(5, 0, 4), P.AUIPC(6, 0), P.ADDI(7, 5, 0), P.ADDI(8, 0, 1), P.BEQ(7, 0, P.Label("x"))],
+                   [0, 1, 3, 2, 4], 1, 0)
+
+    def testLongBlock(self):
+        # Dependences only go back to the nearest instructions they must
+        # follow, so a long block of loads and stores schedules quickly.
+        P = peephole
+        block = []
+        for k in range(1000):
+            block.extend([P.LD(5, 8 * k, 4), P.ADDI(5, 5, 1), P.SD(5, 8 * k, 4)])
+        start = time.time()
+        scheduled, before, after = peephole.schedule_block(block, peephole.LATENCY)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(scheduled, block)
+        self.assertEqual(before, 2 * 1000)
+
+
+class TestCleanup(unittest.TestCase):
+    def program(self, distance):
+        P = peephole
+        o = Optimizer(trace=False)
+        o.I = [
+            P.Label("main"),
+            P.JAL(0, P.Label("start")),
+            P.Label("hop"),
+            P.JAL(0, P.Label("far")),
+            P.Label("start"),
+            # Inverting this would make a branch to far,
+            P.BEQ(5, 0, P.Label("skip")),
+            P.JAL(0, P.Label("far")),
+            P.Label("skip"),
+            # and threading this through hop would too.
+            P.BEQ(6, 0, P.Label("hop")),
+        ]
+        o.I.extend([P.ADDI(7, 7, 1) for _ in range(distance)])
+        o.I.extend([P.Label("far"), P.ADDI(8, 8, 1), P.JALR(0, 0, Optimizer.RA)])
+        return o
+
+    def testFarTargets(self):
+        for distance in [10, 1100]:
+            o = self.program(distance)
+            o.cleanup()
+            o.assemble()
+            for x5, x6, x7 in [(1, 1, 0), (0, 0, 0), (0, 1, distance)]:
+                m = rvsim.Machine(o.I)
+                m.x[5:7] = [x5, x6]
+                m.call("main")
+                self.assertEqual(m.x[7], x7)
+            if distance == 10:
+                # Near enough, both branches go straight to far.
+                branches = [i for i in o.I if i.op in (peephole.OP_BEQ, peephole.OP_BNE)]
+                self.assertEqual([i.label.name for i in branches], ["far", "far"])
+            else:
+                self.assertEqual(len(o.I), len(self.program(distance).I))
+
+
+class TestGolden(unittest.TestCase):
+    def testRows(self):
+        o = Optimizer(trace=False)
+        o.subroutine("rows")
+        for p in ["dup", 8, "xor", "If", "drop", "drop", "drop", "rfs", "Then",
+                  "over", "cfetch", "over", "cstore", 80, "add", "swap",
+                  256, "add", "swap", "call rows", "rfs"]:
+            if isinstance(p, int):
+                o.literal(p)
+            elif p.startswith("call "):
+                o.call(p[5:])
+            else:
+                getattr(o, p)()
+            o.optimize()
+        o.commit(); o.eliminate_stack_traffic(); o.cleanup(); o.schedule()
+        self.assertEqual(o.listing(), "\n".join([
+            "",
+            "rows:",
+            "\txori\tX5, X3, 8",
+            "\tbeq\tX5, X0, .L1",
+            "\tld\tX3, 16(X4)",
+            "\taddi\tX4, X4, 24",
+            "\tjalr\tX0, 0(X1)",
+            "",
+            ".L1:",
+            "\tld\tX5, 0(X4)",
+            "\tlb\tX6, 0(X5)",
+            "\taddi\tX5, X5, 256",
+            "\tsb\tX6, 0(X3)",
+            "\taddi\tX3, X3, 80",
+            "\tsd\tX5, 0(X4)",
+            "\tjal\tX0, rows",
+            "\n",
+        ]) + "\n")
+
+    def testPlotch(self):
+        o = Optimizer(trace=False)
+        o.subroutine("plotch")
+        o.literal(8); o.optimize()
+        o.call("rows"); o.optimize()
+        o.rfs(); o.optimize()
+        o.commit(); o.eliminate_stack_traffic(); o.cleanup(); o.schedule()
+        self.assertEqual(o.listing(), "\n".join([
+            "",
+            "plotch:",
+            "\tori\tX5, X0, 8",
+            "\tsd\tX3, -8(X4)",
+            "\tori\tX3, X5, 0",
+            "\taddi\tX4, X4, -8",
+            "\tjal\tX0, rows",
+            "\n",
+        ]) + "\n")
+
+
+class TestDriver(unittest.TestCase):
+    def compile(self, lines):
+        o = Optimizer(trace=False)
+        peephole.compile_file(o, [l + "\n" for l in lines])
+        peephole.finish(o)
+        return o
+
+    def testSubroutines(self):
+        o = self.compile([
+            "# comment",
+            "subroutine plotch",
+            "",
+            "8",
+            "call rows",
+            "rfs",
+            "subroutine twice",
+            "0x10",
+            "mul_imm 2",
+            "rfs",
+        ])
+        self.assertEqual(o.listing(), "\n".join([
+            "",
+            "plotch:",
+            "\tori\tX5, X0, 8",
+            "\tsd\tX3, -8(X4)",
+            "\tori\tX3, X5, 0",
+            "\taddi\tX4, X4, -8",
+            "\tjal\tX0, rows",
+            "",
+            "twice:",
+            "\tori\tX5, X0, 16",
+            "\tslli\tX5, X5, 1",
+            "\tsd\tX3, -8(X4)",
+            "\tori\tX3, X5, 0",
+            "\taddi\tX4, X4, -8",
+            "\tjalr\tX0, 0(X1)",
+            "\n",
+        ]) + "\n")
+
+    def testErrors(self):
+        for lines, message in [
+            (["subroutine x", "dup", "frob"], "<input>:3: Can't compile 'frob'"),
+            (["subroutine x", "call"], "<input>:2: Can't compile 'call'"),
+            (["subroutine x", "add_imm y"], "<input>:2: Can't compile 'add_imm y'"),
+            (["subroutine x", "if", "rfs"], "if without then"),
+        ]:
+            try:
+                self.compile(lines)
+            except Exception as e:
+                self.assertEqual(str(e), message)
+            else:
+                self.fail("{} compiled".format(lines))
+
+
+def to_lines(name, program):
+    lines = ["subroutine " + name]
+    for word, args in program:
+        if word == "literal":
+            lines.append(str(args[0]))
+        elif len(args) > 0:
+            lines.append("{} {}".format(word, args[0]))
+        else:
+            lines.append(word.lower())
+    lines.append("rfs")
+    return [l + "\n" for l in lines]
+
+
+class TestStatistics(unittest.TestCase):
+    def testSubroutinesAddUp(self):
+        rng = random.Random(2)
+        lines = []
+        while len(lines) < 400:
+            program = Generator(rng).program(rng.randint(5, 25))
+            try:
+                compile_program(program, True)
+            except Exception:
+                continue
+            lines.extend(to_lines("s{}".format(len(lines)), program))
+
+        f = StringIO()
+        o = Optimizer(trace=False, stats_file=f)
+        peephole.compile_file(o, lines)
+        peephole.finish(o)
+        reports = [json.loads(l) for l in f.getvalue().splitlines()]
+        self.assertEqual(len(reports), len([l for l in lines if l.startswith("subroutine")]))
+        total = o.statistics()
+        for key in ["instructions", "stores removed", "stalls hidden", "spills"]:
+            self.assertTrue(total[key] > 0, key)
+        for key in ["instructions", "loads removed", "stores removed", "stalls hidden", "spills", "reloads"]:
+            self.assertEqual(sum([r[key] for r in reports]), total[key], key)
+
+
+class TestParallel(unittest.TestCase):
+    def testMatchesSerial(self):
+        rng = random.Random(1)
+        lines = []
+        names = []
+        while len(names) < 8:
+            program = Generator(rng).program(rng.randint(5, 25))
+            try:
+                compile_program(program, True)
+            except Exception:
+                continue
+            names.append("s{}".format(len(names)))
+            lines.extend(to_lines(names[-1], program))
+        pieces = peephole.split_subroutines(lines)
+        self.assertEqual([p[2][0].split()[1] for p in pieces], names)
+
+        serial = Optimizer(trace=False)
+        peephole.compile_file(serial, lines)
+        peephole.finish(serial)
+        serial.relocate()
+        parallel, stats = peephole.compile_parallel(pieces, 2)
+        parallel.relocate()
+        self.assertEqual([s["subroutine"] for s in stats], names)
+
+        again, stats = peephole.compile_parallel(pieces, 3)
+        self.assertEqual(again.listing(), parallel.listing())
+
+        for name in names:
+            initial = [rng.randint(-(1 << 63), (1 << 63) - 1) for _ in range(INITIAL_DEPTH)]
+            self.assertEqual(execute(serial, initial, name), execute(parallel, initial, name))
+
+
+if __name__ == "__main__":
+    unittest.main()
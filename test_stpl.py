@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import peephole
+import rvsim
+import stpl
+import stplrv
+
+
+STPL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stpl.py')
+
+
+def listing(text):
+    """The assembly listing in stpl.py's output, without the parser trace."""
+    return [l for l in text.splitlines() if not l.startswith('[')]
+
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def stpl(self, args, stdin=''):
+        p = subprocess.Popen([sys.executable, STPL] + args,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+        out, _ = p.communicate(stdin)
+        self.assertEqual(p.returncode, 0)
+        return out
+
+    def testExample(self):
+        lines = listing(self.stpl([]))
+        self.assertEqual(lines[:9], ['%s:  dcw 0' % v for v in
+                                     ['by80', 'ctr', 'x', 'y', 'screenbase', 'w', 'h']] + ['delay:', 'L0:'])
+        # Every label is only ever gone to or called, so none needs a variable.
+        self.assertFalse([l for l in lines if ' dcw L' in l])
+        self.assertEqual(lines[-7:], ['clr:', 'L10:', '  lit L3', '  call', '  lit L7', '  call', '  rfs'])
+
+    def testTrace(self):
+        self.assertEqual(self.stpl(['-'], stdin='declare a;'), 'a:  dcw 0\n')
+        self.assertEqual(self.stpl(['--trace', '-'], stdin='declare a;').splitlines(), [
+            '[] [0]',
+            "['program'] [0, 1]",
+            "['program', 'declare'] [0, 1, 4]",
+            "['program', 'declare', 'WORD'] [0, 1, 4, 16]",
+            "['program', 'declare', 'idlist'] [0, 1, 4, 17]",
+            "['program', 'declare', 'idlist', ';'] [0, 1, 4, 17, 36]",
+            "['program', 'statement'] [0, 1, 8]",
+            "['program'] [0, 1]",
+            'a:  dcw 0',
+        ])
+
+    def testFilesAreOneProgram(self):
+        a = self.write('a.stpl', 'declare a;\nx: let a=a+1')
+        out = os.path.join(self.dir, 'out.s')
+        self.assertEqual(self.stpl(['-o', out, a, '-'], stdin=';\ngoto x;\n'), '')
+        with open(out) as f:
+            self.assertEqual(listing(f.read()), [
+                'a:  dcw 0',
+                'x:', 'L0:',
+                '  lit a', '  fwm', '  lit 1', '  add', '  lit a', '  swm',
+                '  lit L0', '  go',
+            ])
+
+    def testDirectLabels(self):
+        lines = listing(self.stpl(['-'], stdin='goto b; a: return; b: let h = a; call a; goto b if 1;'))
+        self.assertEqual(lines, [
+            '  lit L0', '  go',
+            'L1:', '  rfs',
+            'b:', 'L0:', '  lit a', '  fwm', '  lit h', '  swm',
+            '  lit a', '  fwm', '  call',
+            '  lit L0', '  lit 1', '  lit L2', '  zgo', '  go', 'L2: ',
+            'a: dcw L1',
+        ])
+
+    def testEntryNames(self):
+        lines = listing(self.stpl(['-'], stdin='main: call f; return; f: return;'))
+        self.assertEqual(lines, [
+            'main:', 'L0:', '  lit L1', '  call', '  rfs',
+            'f:', 'L1:', '  rfs',
+        ])
+
+    def testComparisons(self):
+        lines = listing(self.stpl(['-'], stdin='f: goto f if a = 0; return if a # b; let t = a = b;'))
+        self.assertEqual(lines, [
+            'f:', 'L0:', '  lit a', '  fwm', '  lit L0', '  zgo',
+            '  lit a', '  fwm', '  lit b', '  fwm', '  xor', '  lit L1', '  zgo', '  rfs', 'L1: ',
+            '  lit $FFFF', '  lit a', '  fwm', '  lit b', '  fwm', '  xor',
+            '  lit L2', '  zgo', '  lit $FFFF', '  xor', 'L2:', '  lit t', '  swm',
+        ])
+
+    def testConditionLabels(self):
+        self.assertEqual(listing(self.stpl(['-'], stdin='return if x;')), [
+            '  lit x', '  fwm', '  lit L0', '  zgo', '  rfs', 'L0: ',
+        ])
+        # Whichever condition fails, the statement is skipped.
+        self.assertEqual(listing(self.stpl(['-'], stdin='return if a if b;')), [
+            '  lit a', '  fwm', '  lit b', '  fwm',
+            '  lit L0', '  zgo', '  lit L0', '  zgo', '  rfs', 'L0: ',
+        ])
+        lines = listing(self.stpl(['-'], stdin='declare a, b; let a = 1 if a = b if b if a # 2;'))
+        used = set([l.split()[1] for l in lines if l.startswith('  lit L')])
+        placed = set([l.strip()[:-1] for l in lines if l.startswith('L')])
+        self.assertEqual(used, placed)
+
+    def testTokensEndWithFiles(self):
+        a = self.write('a.stpl', 'declare ab')
+        b = self.write('b.stpl', 'c;')
+        lines = listing(self.stpl([a, b]))
+        self.assertEqual(lines, ['SYNTAX ERROR: unexpected WORD'])
+
+
+class TestCompiler(unittest.TestCase):
+    def testInterleaved(self):
+        a = stpl.StringIO()
+        b = stpl.StringIO()
+        ca = stpl.Compiler(stpl.Sink(a))
+        cb = stpl.Compiler(stpl.Sink(b))
+        for ch in stpl.src:
+            ca.feed(ch)
+            cb.feed(ch)
+        ca.finish()
+        cb.finish()
+        self.assertEqual(a.getvalue(), stpl.compilestring(stpl.src))
+        self.assertEqual(b.getvalue(), a.getvalue())
+
+    def testTokensSpanPieces(self):
+        f = stpl.StringIO()
+        c = stpl.Compiler(stpl.Sink(f))
+        for piece in ['decl', 'are a', 'b', '1, c;   ', ' let c=1', '2', '3', ';']:
+            c.feed(piece)
+        c.finish()
+        self.assertEqual(listing(f.getvalue()), listing(stpl.compilestring('declare ab1, c; let c=123;')))
+        self.assertEqual(listing(f.getvalue())[:2], ['ab1:  dcw 0', 'c:  dcw 0'])
+
+    def testThreads(self):
+        programs = [stpl.src, 'declare a;\nx: let a=a+1;\ngoto x;\n'] * 4
+        expected = [stpl.compilestring(p) for p in programs]
+        results = [None] * len(programs)
+
+        def run(n):
+            results[n] = stpl.compilestring(programs[n])
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(len(programs))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, expected)
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testStdio(self):
+        path = os.path.join(self.dir, 'a.stpl')
+        with open(path, 'w') as f:
+            f.write('declare a;')
+        out = os.path.join(self.dir, 'a.s')
+        requests = [
+            {'id': 1, 'source': stpl.src},
+            {'id': 2, 'files': [path], 'output': out},
+            {'id': 3, 'files': [os.path.join(self.dir, 'missing.stpl')]},
+        ]
+        p = subprocess.Popen([sys.executable, STPL, '--serve', '-j', '2'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+        text, _ = p.communicate(''.join([json.dumps(r) + '\n' for r in requests]) + 'junk\n')
+        responses = [json.loads(l) for l in text.splitlines()]
+        self.assertEqual(len(responses), 4)
+        self.assertEqual(responses[0], {'id': 1, 'listing': stpl.compilestring(stpl.src)})
+        self.assertEqual(responses[1], {'id': 2})
+        with open(out) as f:
+            self.assertEqual(listing(f.read()), ['a:  dcw 0'])
+        self.assertEqual(responses[2]['id'], 3)
+        self.assertTrue('missing.stpl' in responses[2]['error'])
+        self.assertTrue(responses[3]['error'].startswith('bad request'))
+
+    def testMalformed(self):
+        requests = [
+            ({'id': 1, 'source': 5}, 'source must be a string'),
+            ({'id': 2, 'files': 'a.stpl'}, 'files must be a list of strings'),
+            ({'id': 3, 'files': ['a.stpl', None]}, 'files must be a list of strings'),
+            ({'id': 4, 'trace': 'yes'}, 'trace must be true or false'),
+            ({'id': 5, 'output': ['a.s']}, 'output must be a string'),
+            ({'id': 6, 'target': 1}, 'target must be a string'),
+            ([1, 2], 'request is not an object'),
+        ]
+        p = subprocess.Popen([sys.executable, STPL, '--serve', '-j', '2'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+        lines = [json.dumps(r) + '\n' for r, error in requests]
+        text, _ = p.communicate(''.join(lines) + json.dumps({'source': 'declare a;'}) + '\n')
+        self.assertEqual(p.returncode, 0)
+        responses = [json.loads(l) for l in text.splitlines()]
+        self.assertEqual(len(responses), len(requests) + 1)
+        for (request, error), response in zip(requests, responses):
+            expected = {'error': 'bad request: ' + error}
+            if isinstance(request, dict):
+                expected['id'] = request['id']
+            self.assertEqual(response, expected)
+        self.assertEqual(responses[-1], {'listing': 'a:  dcw 0\n'})
+
+    def testErrors(self):
+        self.assertEqual(stpl.compilerequest({'id': 1, 'source': 'declare a;', 'target': 'vax'}),
+                         {'id': 1, 'error': 'no target vax'})
+        response = stpl.compilerequest({'id': 2, 'source': 'f: let a = b; return;', 'target': 'riscv'})
+        self.assertEqual(response, {'id': 2, 'error': 'Undeclared: a, b'})
+
+    def testSocket(self):
+        path = os.path.join(self.dir, 'stpl.sock')
+        p = subprocess.Popen([sys.executable, STPL, '--socket', path, '-j', '2'])
+        try:
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            s = socket.socket(socket.AF_UNIX)
+            s.connect(path)
+            f = s.makefile('rb')
+            for n in range(3):
+                s.sendall((json.dumps({'id': n, 'source': stpl.src}) + '\n').encode('utf-8'))
+                response = json.loads(f.readline().decode('utf-8'))
+                self.assertEqual(response, {'id': n, 'listing': stpl.compilestring(stpl.src)})
+            f.close()
+            s.close()
+        finally:
+            p.terminate()
+            p.wait()
+        # Stopping the server removes its socket, so it can start again.
+        self.assertEqual(p.returncode, 0)
+        self.assertFalse(os.path.exists(path))
+
+
+class TestRiscV(unittest.TestCase):
+    def build(self, text):
+        f = stpl.StringIO()
+        c = stpl.Compiler(stpl.Sink(f), target='riscv')
+        c.feed(text)
+        c.finish()
+        self.backend = c.backend
+        o = c.backend.o
+        m = rvsim.Machine(o.I, list(o.C))
+        m.x[peephole.Optimizer.DSP] = 0x800000
+        m.x[peephole.Optimizer.RSP] = 0x900000
+        m.call(stplrv.INIT)
+        return m
+
+    def address(self, name):
+        o = self.backend.o
+        return 0x10000 + 8 * len(o.C) + o.C.address(self.backend.slots[name])
+
+    def get(self, m, name):
+        return rvsim.signed64(m.load(self.address(name), 8))
+
+    def set(self, m, name, value):
+        m.store(self.address(name), value, 8)
+
+    def testLoop(self):
+        m = self.build('''
+            declare n, total;
+            sum:    let total = 0;
+            loop:   return if n = 0;
+                    let total = total + n; let n = n - 1; goto loop;
+            twice:  call sum; let n = total; call sum; return;
+        ''')
+        self.set(m, 'n', 10)
+        m.call('sum')
+        self.assertEqual(self.get(m, 'total'), 55)
+        self.set(m, 'n', 4)
+        m.call('twice')
+        self.assertEqual(self.get(m, 'total'), 55)
+
+    def testExpressions(self):
+        m = self.build('''
+            declare n, p, a, b, c, d, e, hook;
+            f:  let a = (n = 3) ^ 1; let b = n # 3; let c = 255 ~ 15;
+                let !p = 77; let d = !p + (p!8) - 2;
+                let e = 1 if 0; let c = 9 if a if 1;
+                let hook = f; return;
+        ''')
+        self.set(m, 'n', 3)
+        self.set(m, 'p', 0x300000)
+        m.store(0x300008, 5, 8)
+        m.call('f')
+        self.assertEqual([self.get(m, v) for v in ['a', 'b', 'c', 'd', 'e']], [-2, 0, 9, 80, 0])
+        self.assertEqual(self.get(m, 'hook'), m.labels['f'])
+
+    def testConditions(self):
+        m = self.build('''
+            declare n, count, hook;
+            f:  let count = 0;
+            g:  let count = count + 1 if n # 4; let n = n + 1; goto g if n = 1;
+                let hook = g; goto hook if n = 2; return if count = 3; let n = 0; return;
+        ''')
+        for n, count, after in [(0, 3, 3), (4, 0, 0), (1, 2, 0), (7, 1, 0)]:
+            self.set(m, 'n', n)
+            m.call('f')
+            self.assertEqual([self.get(m, 'count'), self.get(m, 'n')], [count, after])
+
+    def testExample(self):
+        m = self.build(stpl.src)
+        self.set(m, 'w', 5)
+        self.set(m, 'h', 3)
+        self.set(m, 'screenbase', 0x400000)
+        self.set(m, 'by80', 0x500000)
+        m.call('clr')
+        self.assertEqual([self.get(m, 'x'), self.get(m, 'y')], [0, 3])
+        self.assertEqual([m.load(0x400000 + k, 1) for k in range(6)], [32] * 5 + [0])
+
+    def testDeepExpressions(self):
+        # Deeper than there are registers to cache the stack in.
+        def nested(last):
+            # 1+(2+(...+(11+(last)))), which is 66+last.
+            return ''.join(['%d+(' % k for k in range(1, 12)]) + last + ')' * 11
+        m = self.build('''
+            declare a, b, c, p;
+            f:  let a = %s; return;
+            g:  let b = %s if a = %s;
+                let !(p + %s) = %s;
+                let c = 1 if b # %s;
+                return;
+        ''' % (nested('0'), nested('(a=66)'), nested('a-66'), nested('0'), nested('b'), nested('0')))
+        m.call('f')
+        self.assertEqual(self.get(m, 'a'), 66)
+        self.set(m, 'p', 0x300000)
+        m.call('g')
+        self.assertEqual(self.get(m, 'b'), 65)
+        self.assertEqual(self.get(m, 'p'), 0x300000)
+        self.assertEqual(m.load(0x300000 + 66, 8), 131)
+        self.assertEqual(self.get(m, 'c'), 1)
+        self.assertEqual(m.x[peephole.Optimizer.DSP], 0x800000)
+
+    def testLabelNames(self):
+        # Labels the code generator makes up can't be mistaken for STPL's.
+        m = self.build('''
+            declare a, r;
+            f:  let r = 1; return if a; let r = 2; return;
+            L1: let r = 99; return;
+        ''')
+        m.call('f')
+        self.assertEqual(self.get(m, 'r'), 2)
+        with self.assertRaises(Exception) as cm:
+            self.build('f: return; f: return;')
+        self.assertEqual(str(cm.exception), 'Duplicate label f')
+
+    def testRepeatable(self):
+        # Each compile numbers its own labels, whatever came before it.
+        src = 'declare n; f: return if n = 0; let n = 1; return;'
+        listing = stpl.compilestring(src, target='riscv')
+        self.assertTrue('.L1:' in listing)
+        self.assertEqual(stpl.compilestring(src, target='riscv'), listing)
+
+    def testUndeclared(self):
+        with self.assertRaises(Exception) as cm:
+            stpl.compilestring('f: let a = b; return;', target='riscv')
+        self.assertEqual(str(cm.exception), 'Undeclared: a, b')
+
+
+if __name__ == '__main__':
+    unittest.main()